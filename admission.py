@@ -0,0 +1,142 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from observability import counter, histogram
+
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', 20))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 5))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 500))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 20))
+
+# Lower runs first. Handlers set this for the update they are serving; the
+# outbound AI clients read it when they queue for a slot.
+HIGHEST_PRIORITY = 0
+DEFAULT_PRIORITY = 10
+BACKGROUND_PRIORITY = 20
+current_priority = contextvars.ContextVar('current_priority', default=DEFAULT_PRIORITY)
+
+_rejected = counter('admission_rejected_total', 'AI calls turned away by admission control')
+_queue_wait = histogram('admission_queue_wait_seconds', 'Time AI calls spent queued for a slot')
+
+
+class AdmissionRejected(Exception):
+    """Raised when an AI call cannot get a slot within the queue limits."""
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """Token bucket per key, keeping at most `maxsize` idle buckets."""
+
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST, maxsize=100000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def allow(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take()
+
+
+class PriorityScheduler:
+    """Concurrency limit whose waiters are served by priority, then arrival.
+
+    When every slot is busy a caller queues; it is rejected with
+    AdmissionRejected if the queue already holds `max_queue` callers or it
+    waited longer than `max_wait` seconds, so overload fails fast instead of
+    growing tail latency without bound.
+    """
+
+    def __init__(self, slots, max_queue=ADMISSION_MAX_QUEUE, max_wait=ADMISSION_MAX_WAIT, name='ai'):
+        self.name = name
+        self.free = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._waiters = []  # heap; may still hold waiters that gave up
+        self._queued = 0  # callers actually waiting
+        self._order = itertools.count()
+
+    async def acquire(self, priority=None):
+        if priority is None:
+            priority = current_priority.get()
+        if self.free > 0 and not self._queued:
+            self.free -= 1
+            return
+        if self._queued >= self.max_queue:
+            _rejected.inc(scheduler=self.name, reason='queue_full')
+            raise AdmissionRejected("AI request queue is full")
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        self._queued += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            self._give_back(waiter)
+            _rejected.inc(scheduler=self.name, reason='timeout')
+            raise AdmissionRejected(f"no AI slot free within {self.max_wait}s") from None
+        except asyncio.CancelledError:
+            self._give_back(waiter)
+            raise
+        finally:
+            self._queued -= 1
+            self._prune()
+        _queue_wait.observe(time.monotonic() - started, scheduler=self.name, priority=priority)
+
+    def _give_back(self, waiter):
+        # The slot may have been handed over just before the timeout or
+        # cancellation; pass it on rather than leak it.
+        if waiter.done() and not waiter.cancelled():
+            self.release()
+
+    def _prune(self):
+        # Waiters that gave up are skipped by release(); drop them once they
+        # outnumber the live ones so the heap doesn't grow without bound.
+        if len(self._waiters) > 2 * self._queued + 64:
+            self._waiters = [entry for entry in self._waiters if not entry[2].done()]
+            heapq.heapify(self._waiters)
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+    @asynccontextmanager
+    async def slot(self, priority=None):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import asyncio
+import logging
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# Audio work is done by ffmpeg in child processes, at most AUDIO_WORKERS at a
+# time, so decoding and encoding never run on the event loop. Without ffmpeg
+# every function here passes its input through unchanged.
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS', os.cpu_count() or 2))
+AUDIO_TIMEOUT = float(os.getenv('AUDIO_TIMEOUT', 15))
+SILENCE_THRESHOLD = os.getenv('SILENCE_THRESHOLD', '-45dB')
+SILENCE_PADDING = float(os.getenv('SILENCE_PADDING', 0.2))
+MIN_SPEECH_SECONDS = float(os.getenv('MIN_SPEECH_SECONDS', 0.3))
+TRANSCRIBE_SAMPLE_RATE = 16000
+TRANSCRIBE_BITRATE = os.getenv('TRANSCRIBE_BITRATE', '24k')
+VOICE_BITRATE = os.getenv('VOICE_BITRATE', '32k')
+
+FFMPEG = shutil.which(FFMPEG_BINARY)
+# Format synthesize() hands to sendVoice: Telegram plays OGG/Opus as a voice note.
+VOICE_FORMAT = 'ogg' if FFMPEG else 'mp3'
+
+# silenceremove only trims the start, so the end is trimmed on the reversed signal.
+_trim = f"silenceremove=start_periods=1:start_threshold={SILENCE_THRESHOLD}:start_silence={SILENCE_PADDING}"
+TRIM_FILTER = f"{_trim},areverse,{_trim},areverse"
+
+_pool = asyncio.Semaphore(AUDIO_WORKERS)
+
+
+class AudioError(Exception):
+    """Raised when ffmpeg fails or takes longer than AUDIO_TIMEOUT."""
+
+
+async def run_ffmpeg(args, data, timeout=AUDIO_TIMEOUT):
+    """Pipe `data` through `ffmpeg <args>` and return what it writes to stdout."""
+    async with _pool:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG, '-hide_banner', '-loglevel', 'error', *args,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            output, errors = await asyncio.wait_for(process.communicate(data), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise AudioError(f"ffmpeg took longer than {timeout}s") from None
+    if process.returncode != 0:
+        raise AudioError(errors.decode(errors='replace').strip()[-500:])
+    return output
+
+
+def ogg_duration(data):
+    """Length in seconds of an OGG/Opus stream; None if `data` isn't one."""
+    position, granule, pre_skip = 0, None, None
+    while data.startswith(b'OggS', position) and position + 27 <= len(data):
+        segments = data[position + 26]
+        body = position + 27 + segments
+        if pre_skip is None and data.startswith(b'OpusHead', body):
+            pre_skip = int.from_bytes(data[body + 10:body + 12], 'little')
+        granule = int.from_bytes(data[position + 6:position + 14], 'little', signed=True)
+        position = body + sum(data[position + 27:body])
+    if pre_skip is None:
+        return None
+    # Opus granule positions count 48 kHz samples whatever the input rate.
+    return max(0.0, (granule - pre_skip) / 48000)
+
+
+async def prepare_for_transcription(audio: BytesIO):
+    """Trimmed 16 kHz mono copy of a voice note, for a smaller, faster Whisper upload.
+
+    Returns None if nothing but silence is left. If ffmpeg is missing or
+    fails, the original recording is returned so transcription still works.
+    """
+    if not FFMPEG:
+        return audio
+    try:
+        trimmed = await run_ffmpeg([
+            '-i', 'pipe:0', '-af', TRIM_FILTER,
+            '-ac', '1', '-ar', str(TRANSCRIBE_SAMPLE_RATE),
+            '-c:a', 'libopus', '-b:a', TRANSCRIBE_BITRATE, '-application', 'voip',
+            '-f', 'ogg', 'pipe:1',
+        ], audio.getvalue())
+    except AudioError as e:
+        logger.warning(f"Could not preprocess voice note, sending it as is: {e}")
+        return audio
+    duration = ogg_duration(trimmed)
+    if duration is not None and duration < MIN_SPEECH_SECONDS:
+        return None
+    prepared = BytesIO(trimmed)
+    prepared.name = 'voice.ogg'  # the OpenAI client uses the name to infer the format
+    return prepared
+
+
+async def to_voice(mp3):
+    """Transcode synthesised MP3 to mono OGG/Opus for sendVoice.
+
+    Returns the MP3 unchanged when ffmpeg isn't installed; callers that
+    cache the result should key on VOICE_FORMAT.
+    """
+    if not FFMPEG:
+        return mp3
+    return await run_ffmpeg([
+        '-f', 'mp3', '-i', 'pipe:0',
+        '-ac', '1', '-ar', '48000',
+        '-c:a', 'libopus', '-b:a', VOICE_BITRATE, '-application', 'voip',
+        '-f', 'ogg', 'pipe:1',
+    ], mp3)
@@ -0,0 +1,86 @@
+import os
+import logging
+import argparse
+from datetime import datetime
+from sqlalchemy import or_, update
+from models import Session, StripeLink, User
+from observability import timed
+
+logger = logging.getLogger(__name__)
+
+
+def subscription_period_end(subscription):
+    # Older Stripe API versions put the period on the subscription, newer
+    # ones on each of its items.
+    if subscription.get('current_period_end'):
+        return datetime.utcfromtimestamp(subscription['current_period_end'])
+    ends = [item['current_period_end'] for item in (subscription.get('items') or {}).get('data') or []
+            if item.get('current_period_end')]
+    return datetime.utcfromtimestamp(max(ends)) if ends else None
+
+
+def list_subscriptions(api_key):
+    import stripe
+
+    with timed('stripe_api_seconds', 'Stripe API latency', call='Subscription.list'):
+        yield from stripe.Subscription.list(api_key=api_key, status='all', limit=100).auto_paging_iter()
+
+
+def backfill_subscribed_until(subscriptions, dry_run=False):
+    """Set subscribed_until of active users from their Stripe subscriptions' current period.
+
+    Subscriptions are matched to users by telegram_id metadata or by the
+    subscription and customer ids recorded in stripe_links. subscribed_until
+    is only ever moved forward. Returns (updated telegram_ids, active
+    telegram_ids no subscription was found for).
+    """
+    with Session() as session:
+        links = dict(
+            session.query(StripeLink.stripe_id, StripeLink.telegram_id)
+            .filter(StripeLink.kind.in_(('customer', 'subscription')))
+        )
+    period_ends = {}
+    for subscription in subscriptions:
+        telegram_id = ((subscription.get('metadata') or {}).get('telegram_id')
+                       or links.get(subscription['id']) or links.get(subscription.get('customer')))
+        period_end = subscription_period_end(subscription)
+        if telegram_id and period_end:
+            telegram_id = str(telegram_id)
+            period_ends[telegram_id] = max(period_end, period_ends.get(telegram_id, period_end))
+
+    updated = []
+    with Session() as session:
+        for telegram_id, period_end in period_ends.items():
+            result = session.execute(
+                update(User)
+                .where(User.telegram_id == telegram_id, User.subscription_status == 'active',
+                       or_(User.subscribed_until.is_(None), User.subscribed_until < period_end))
+                .values(subscribed_until=period_end)
+                .returning(User.telegram_id)
+            )
+            updated.extend(result.scalars().all())
+        missing = [telegram_id for telegram_id, in
+                   session.query(User.telegram_id).filter(User.subscription_status == 'active')
+                   if telegram_id not in period_ends]
+        if dry_run:
+            session.rollback()
+        else:
+            session.commit()
+    return updated, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Set subscribed_until from Stripe for every active user. Run once before enabling the expiry sweep.")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change without writing it")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    updated, missing = backfill_subscribed_until(list_subscriptions(os.getenv('STRIPE_SECRET_KEY')), dry_run=args.dry_run)
+    print(f"{'Would update' if args.dry_run else 'Updated'} subscribed_until for {len(updated)} users.")
+    for telegram_id in missing:
+        print(f"User with telegram_id {telegram_id} is active but has no Stripe subscription; the sweep will expire them.")
+
+
+if __name__ == '__main__':
+    main()
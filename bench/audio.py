@@ -0,0 +1,160 @@
+"""Checks and timings for audio.py on synthetic recordings.
+
+Builds voice notes the way Telegram sends them (OGG/Opus, 48 kHz) and TTS
+clips the way ElevenLabs returns them (MP3), from generated signals: a
+speech-like tone with leading and trailing silence, pure silence, and a
+recording with no silence at all. Each is run through audio.py, the results
+are checked, and sizes and timings are reported. Needs ffmpeg; run from the
+repository root:
+
+    python -m bench.audio --jobs 50 --ffmpeg /usr/bin/ffmpeg
+
+Exits non-zero if a check fails.
+"""
+import os
+import sys
+import math
+import time
+import wave
+import array
+import random
+import asyncio
+import argparse
+from io import BytesIO
+
+SAMPLE_RATE = 48000
+
+
+def speech_like(seconds, rng):
+    """Harmonics of a 150 Hz voice, amplitude-modulated at syllable rate."""
+    samples = []
+    for n in range(int(seconds * SAMPLE_RATE)):
+        t = n / SAMPLE_RATE
+        envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 4 * t)
+        tone = sum(math.sin(2 * math.pi * 150 * k * t) / k for k in range(1, 6))
+        samples.append(0.25 * envelope * tone + rng.gauss(0, 0.002))
+    return samples
+
+
+def silence(seconds, rng):
+    # A faint noise floor, as a real microphone would pick up.
+    return [rng.gauss(0, 0.0005) for _ in range(int(seconds * SAMPLE_RATE))]
+
+
+def to_wav(samples):
+    pcm = array.array('h', (max(-32767, min(32767, int(sample * 32767))) for sample in samples))
+    buffer = BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+async def fixtures(audio):
+    rng = random.Random(7)
+    signals = {
+        'padded speech': silence(1.0, rng) + speech_like(2.0, rng) + silence(1.5, rng),
+        'silence only': silence(3.0, rng),
+        'speech only': speech_like(2.0, rng),
+    }
+    voice_notes = {}
+    for name, samples in signals.items():
+        voice_notes[name] = await audio.run_ffmpeg(
+            ['-f', 'wav', '-i', 'pipe:0', '-c:a', 'libopus', '-b:a', '32k', '-f', 'ogg', 'pipe:1'], to_wav(samples))
+    tts = await audio.run_ffmpeg(
+        ['-f', 'wav', '-i', 'pipe:0', '-ar', '44100', '-c:a', 'libmp3lame', '-b:a', '128k', '-f', 'mp3', 'pipe:1'],
+        to_wav(signals['speech only']))
+    return voice_notes, tts
+
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def expect(self, condition, description):
+        print(f"  {'ok  ' if condition else 'FAIL'} {description}")
+        if not condition:
+            self.failed += 1
+
+
+async def timed(coroutine):
+    started = time.perf_counter()
+    result = await coroutine
+    return result, (time.perf_counter() - started) * 1000
+
+
+async def main_async(args):
+    import audio
+
+    if not audio.FFMPEG:
+        print(f"ffmpeg not found (FFMPEG_BINARY={audio.FFMPEG_BINARY}); nothing to measure")
+        return 2
+    checks = Checks()
+    voice_notes, tts = await fixtures(audio)
+
+    print("prepare_for_transcription")
+    for name, data in voice_notes.items():
+        source = BytesIO(data)
+        source.name = 'voice.ogg'
+        prepared, elapsed = await timed(audio.prepare_for_transcription(source))
+        before = audio.ogg_duration(data)
+        if prepared is None:
+            print(f"  {name:<14} {len(data):>7} B {before:5.2f}s -> dropped as silence ({elapsed:.1f} ms)")
+        else:
+            after = audio.ogg_duration(prepared.getvalue())
+            print(f"  {name:<14} {len(data):>7} B {before:5.2f}s -> {len(prepared.getvalue()):>7} B "
+                  f"{after:5.2f}s ({elapsed:.1f} ms)")
+        if name == 'padded speech':
+            checks.expect(prepared is not None and after < before - 1.5,
+                          "leading and trailing silence is trimmed")
+            checks.expect(prepared is not None and after >= 2.0 - 0.1,
+                          "the speech itself is kept")
+            checks.expect(prepared is not None and len(prepared.getvalue()) < len(data),
+                          "the upload gets smaller")
+        elif name == 'silence only':
+            checks.expect(prepared is None, "a silent note is not sent to Whisper")
+        else:
+            checks.expect(prepared is not None and abs(after - before) < 0.3,
+                          "a note without silence keeps its length")
+
+    print("to_voice")
+    voice, elapsed = await timed(audio.to_voice(tts))
+    print(f"  mp3 {len(tts)} B -> ogg/opus {len(voice)} B ({elapsed:.1f} ms)")
+    checks.expect(voice.startswith(b'OggS') and b'OpusHead' in voice, "output is OGG/Opus")
+    checks.expect(abs(audio.ogg_duration(voice) - 2.0) < 0.2, "duration is preserved")
+    checks.expect(len(voice) < len(tts), "output is smaller than the MP3")
+
+    print(f"throughput, {args.jobs} voice notes with {audio.AUDIO_WORKERS} workers")
+    started = time.perf_counter()
+    sources = []
+    for _ in range(args.jobs):
+        source = BytesIO(voice_notes['padded speech'])
+        source.name = 'voice.ogg'
+        sources.append(audio.prepare_for_transcription(source))
+    await asyncio.gather(*sources)
+    elapsed = time.perf_counter() - started
+    print(f"  {args.jobs / elapsed:.1f} notes/s ({elapsed * 1000 / args.jobs:.1f} ms each on average)")
+
+    print(f"{checks.failed} checks failed" if checks.failed else "all checks passed")
+    return 1 if checks.failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the voice preprocessing stage.")
+    parser.add_argument('--jobs', type=int, default=50, help="voice notes to process concurrently")
+    parser.add_argument('--ffmpeg', help="ffmpeg binary to use instead of the one on PATH")
+    parser.add_argument('--workers', type=int, help="override AUDIO_WORKERS")
+    args = parser.parse_args()
+
+    # audio.py reads its settings at import.
+    if args.ffmpeg:
+        os.environ['FFMPEG_BINARY'] = args.ffmpeg
+    if args.workers:
+        os.environ['AUDIO_WORKERS'] = str(args.workers)
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Fake Telegram update source for checking webhook routing.
+
+Pushes synthetic updates for many chats through tgrouter's router into
+in-process recording workers, then checks that every chat stuck to a single
+worker, how evenly chats spread, and how many chats move when a worker is
+removed. Run from the repository root:
+
+    python -m bench.fake_telegram --workers 4 --chats 1000 --updates 10000
+"""
+import sys
+import asyncio
+import argparse
+import itertools
+import random
+from collections import defaultdict
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+from sharding import routing_key
+from tgrouter import create_router
+
+_update_ids = itertools.count(1)
+
+
+def make_update(chat_id, text='hi'):
+    """A minimal private-chat update, in the shape Telegram posts it."""
+    update_id = next(_update_ids)
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+    if random.random() < 0.2:
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': user,
+                'chat_instance': str(chat_id),
+                'data': '0',
+                'message': {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'Please choose:'},
+            },
+        }
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'from': user, 'chat': {'id': chat_id, 'type': 'private'}, 'text': text},
+    }
+
+
+def recording_worker(name, received):
+    async def update(request):
+        received[routing_key(await request.json())].add(name)
+        return Response(status_code=200)
+    return Starlette(routes=[Route('/update', update, methods=['POST'])])
+
+
+async def route_all(worker_names, updates, concurrency=100):
+    """Send `updates` through a router over `worker_names`; returns chat id -> workers that got it."""
+    received = defaultdict(set)
+    mounts = {name: httpx.ASGITransport(app=recording_worker(name, received)) for name in worker_names}
+    async with httpx.AsyncClient(mounts=mounts) as worker_client:
+        router = create_router(worker_names, secret=None, client=worker_client)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=router), base_url='http://router') as telegram:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def deliver(update):
+                async with slots:
+                    response = await telegram.post('/telegram', json=update)
+                    response.raise_for_status()
+
+            await asyncio.gather(*(deliver(update) for update in updates))
+    return received
+
+
+async def run(workers, chats, updates):
+    names = [f'http://worker-{index}' for index in range(workers)]
+    chat_ids = random.sample(range(10_000, 10_000_000), chats)
+    batch = [make_update(random.choice(chat_ids)) for _ in range(updates)]
+
+    received = await route_all(names, batch)
+    split = [chat_id for chat_id, got in received.items() if len(got) > 1]
+    load = defaultdict(int)
+    for got in received.values():
+        load[next(iter(got))] += 1
+    print(f"{updates} updates for {len(received)} chats over {workers} workers")
+    for name in names:
+        print(f"  {name}: {load[name]} chats")
+    print(f"  chats split across workers: {len(split)}")
+
+    moved = 0
+    if workers > 1:
+        placement = {chat_id: next(iter(got)) for chat_id, got in received.items()}
+        removed = names[-1]
+        after = await route_all(names[:-1], [make_update(chat_id) for chat_id in placement])
+        moved = sum(1 for chat_id, got in after.items() if placement[chat_id] != removed and got != {placement[chat_id]})
+        print(f"  after removing {removed}: {moved} chats from surviving workers moved (expected 0)")
+
+    return not split and not moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=10000)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args.workers, args.chats, args.updates)) else 1)
+
+
+if __name__ == '__main__':
+    main()
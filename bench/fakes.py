@@ -0,0 +1,254 @@
+"""Local stand-ins for Telegram, OpenAI, ElevenLabs and Stripe.
+
+Each fake is a small aiohttp app that answers the handful of endpoints the bot
+and the webhook actually call, after a configurable delay, and fails a
+configurable share of requests so error paths get exercised too.
+"""
+import json
+import time
+import asyncio
+import random
+import itertools
+from collections import defaultdict
+from aiohttp import web
+
+
+class Behaviour:
+    """Latency and error injection shared by every endpoint of one fake.
+
+    `slow_rate` of the requests take an extra `slow_latency` seconds, to
+    model the long tail real APIs have.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, slow_rate=0.0, slow_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+
+    async def delay(self, scale=1.0):
+        pause = max(0.0, random.gauss(self.latency, self.jitter)) * scale
+        if self.slow_rate and random.random() < self.slow_rate:
+            pause += self.slow_latency
+        if pause:
+            await asyncio.sleep(pause)
+
+    def should_fail(self):
+        return self.error_rate and random.random() < self.error_rate
+
+
+def _error(status=500):
+    return web.json_response({'error': {'message': 'injected failure', 'type': 'server_error'}}, status=status)
+
+
+class FakeService:
+    def __init__(self, behaviour=None):
+        self.behaviour = behaviour or Behaviour()
+        self.calls = defaultdict(int)
+        self.app = web.Application(client_max_size=32 * 1024 * 1024)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1'):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeOpenAI(FakeService):
+    REPLY = ("Jamie: Hey! It's so good to hear from you. I was just thinking we should grab some "
+             "ice-cream and take the dogs for a walk once it cools down a bit. What are we up to today?")
+
+    def __init__(self, behaviour=None, chunk_delay=0.01):
+        super().__init__(behaviour)
+        self.chunk_delay = chunk_delay
+        self.app.add_routes([
+            web.post('/v1/chat/completions', self.chat),
+            web.post('/v1/audio/transcriptions', self.transcribe),
+        ])
+
+    async def chat(self, request):
+        self.calls['chat'] += 1
+        body = await request.json()
+        await self.behaviour.delay()
+        if self.behaviour.should_fail():
+            return _error()
+        reply = self.REPLY
+        if not body.get('stream'):
+            return web.json_response({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for word in reply.split(' '):
+            chunk = {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def transcribe(self, request):
+        self.calls['transcribe'] += 1
+        await request.read()
+        await self.behaviour.delay()
+        if self.behaviour.should_fail():
+            return _error()
+        return web.json_response({'text': 'hey jamie, want to get some ice-cream later?'})
+
+
+class FakeElevenLabs(FakeService):
+    AUDIO = b'ID3' + bytes(24 * 1024)
+
+    def __init__(self, behaviour=None):
+        super().__init__(behaviour)
+        self.app.add_routes([web.post('/v1/text-to-speech/{voice_id}/stream', self.synthesize)])
+
+    async def synthesize(self, request):
+        self.calls['tts'] += 1
+        await request.json()
+        await self.behaviour.delay()
+        if self.behaviour.should_fail():
+            return _error()
+        return web.Response(body=self.AUDIO, content_type='audio/mpeg')
+
+
+class FakeTelegram(FakeService):
+    """Bot API stand-in that records when each chat first hears back.
+
+    `waiter(chat_id)` returns a future resolved with the time of the first
+    message the bot sends to that chat, which is what the load generator
+    measures latency against.
+    """
+
+    VOICE = b'OggS' + bytes(8 * 1024)
+
+    def __init__(self, behaviour=None):
+        super().__init__(behaviour)
+        self._message_ids = itertools.count(1)
+        self._waiters = {}
+        self.app.add_routes([
+            web.post('/bot{token}/{method}', self.method),
+            web.get('/file/bot{token}/{path:.*}', self.file),
+        ])
+
+    def waiter(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[int(chat_id)] = future
+        return future
+
+    def _delivered(self, chat_id):
+        future = self._waiters.pop(int(chat_id), None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    def _message(self, chat_id, **extra):
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'}, **extra}
+
+    async def method(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        await self.behaviour.delay()
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'CustomFriend', 'username': 'AI_friend_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        elif method in ('sendMessage', 'editMessageText'):
+            if self.behaviour.should_fail():
+                return web.json_response({'ok': False, 'error_code': 500, 'description': 'injected failure'}, status=500)
+            result = self._message(params['chat_id'], text=params.get('text', ''))
+            self._delivered(params['chat_id'])
+        elif method == 'sendVoice':
+            result = self._message(params['chat_id'], voice={'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 3})
+            self._delivered(params['chat_id'])
+        elif method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                      'file_size': len(self.VOICE), 'file_path': f"voice/{params['file_id']}.oga"}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def file(self, request):
+        self.calls['file'] += 1
+        await self.behaviour.delay(0.5)
+        return web.Response(body=self.VOICE, content_type='audio/ogg')
+
+
+class FakeStripe(FakeService):
+    def __init__(self, behaviour=None):
+        super().__init__(behaviour)
+        self._sessions = itertools.count(1)
+        self.app.add_routes([
+            web.post('/v1/checkout/sessions', self.create_checkout),
+            web.get('/v1/{kind}/{object_id}', self.retrieve),
+            web.post('/v1/{kind}/{object_id}', self.update),
+        ])
+
+    OBJECT_TYPES = {
+        'invoices': 'invoice', 'subscriptions': 'subscription',
+        'payment_intents': 'payment_intent', 'charges': 'charge', 'customers': 'customer',
+    }
+
+    def _object(self, kind, object_id, metadata=None):
+        obj = {'id': object_id, 'object': self.OBJECT_TYPES.get(kind, kind), 'metadata': metadata or {}}
+        if kind == 'invoices':
+            obj['subscription'] = f"sub_{object_id[3:]}"
+            obj['customer'] = f"cus_{object_id[3:]}"
+        return obj
+
+    async def retrieve(self, request):
+        kind = request.match_info['kind']
+        self.calls[f'retrieve_{kind}'] += 1
+        await self.behaviour.delay()
+        if self.behaviour.should_fail():
+            return _error()
+        object_id = request.match_info['object_id']
+        # Ids minted by the load generator end in the telegram id they belong to.
+        metadata = {'telegram_id': object_id.rsplit('_', 1)[-1]} if kind == 'subscriptions' else {}
+        return web.json_response(self._object(kind, object_id, metadata))
+
+    async def update(self, request):
+        kind = request.match_info['kind']
+        self.calls[f'update_{kind}'] += 1
+        params = await request.post()
+        await self.behaviour.delay()
+        if self.behaviour.should_fail():
+            return _error()
+        metadata = {key[9:-1]: value for key, value in params.items() if key.startswith('metadata[')}
+        return web.json_response(self._object(kind, request.match_info['object_id'], metadata))
+
+    async def create_checkout(self, request):
+        self.calls['create_checkout'] += 1
+        params = await request.post()
+        await self.behaviour.delay()
+        if self.behaviour.should_fail():
+            return _error()
+        session_id = f"cs_test_{next(self._sessions)}"
+        return web.json_response({
+            'id': session_id, 'object': 'checkout.session', 'url': f"{self.url}/pay/{session_id}",
+            'expires_at': int(params.get('expires_at') or time.time() + 86400),
+            'metadata': {key[9:-1]: value for key, value in params.items() if key.startswith('metadata[')},
+        })
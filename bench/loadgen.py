@@ -0,0 +1,375 @@
+"""Offline load test for bot.py and webhook.py.
+
+Starts the fakes from bench/fakes.py, points the bot, the webhook and their
+SDKs at them, and uses SQLite in a temporary directory unless --database-url
+is given. Then it drives text messages, voice messages, /start, checkout
+button taps and Stripe webhook deliveries at a fixed arrival rate. Run from
+the repository root:
+
+    python -m bench.loadgen --rate 50 --duration 30 --mix text=60,voice=15,start=10,stripe=15
+
+Bot latency is measured from the moment an update is queued until the fake
+Telegram receives the first message for that chat (time to first reply).
+Webhook latency is the time until stripe_webhook acknowledges the event.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tempfile
+import resource
+import importlib
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from bench.fakes import Behaviour, FakeElevenLabs, FakeOpenAI, FakeStripe, FakeTelegram
+
+SCENARIOS = ('text', 'voice', 'start', 'checkout', 'stripe')
+FIRST_USER_ID = 700_000_000
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}; expected one of {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def behaviour(args, service):
+    latency = getattr(args, f'{service}_latency')
+    # Errors are switched on once warm-up is done; see LoadTest.run.
+    result = Behaviour(args.latency if latency is None else latency, args.jitter)
+    if service == 'openai':
+        result.slow_rate = args.openai_slow_rate
+        result.slow_latency = args.openai_slow_latency
+    return result
+
+
+def configure_environment(args, fakes, workdir):
+    """Point every client at the fakes. Must run before bot/webhook are imported."""
+    os.environ.update({
+        'DATABASE_URL': args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'TELEGRAM_TOKEN': '123456:bench',
+        'TELEGRAM_API_BASE': fakes['telegram'].url,
+        'OPENAI_KEY': 'sk-bench',
+        'OPENAI_API_BASE': f"{fakes['openai'].url}/v1",
+        'ELEVEN_LABS_API_KEY': 'bench',
+        'ELEVEN_API_BASE': fakes['tts'].url,
+        'STRIPE_SECRET_KEY': 'sk_test_bench',
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts'),
+        'COALESCE_WINDOW': str(args.coalesce_window),
+        'STREAM_REPLIES': '1' if args.stream else '0',
+        'RATE_LIMIT_PER_MINUTE': '1000000',
+        'RATE_LIMIT_BURST': '1000000',
+        'SWEEP_INTERVAL': '0',
+        'LLM_HEDGE_BUDGET': str(args.hedge_budget),
+    })
+
+
+class LoadTest:
+    def __init__(self, args, fakes):
+        self.args = args
+        self.fakes = fakes
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._user_ids = itertools.count(FIRST_USER_ID)
+        self._update_ids = itertools.count(1)
+        self._idle_users = asyncio.Queue()
+        self._rss_peak = 0
+
+    def setup(self):
+        # The schema has to exist before webhook.py starts its event queue.
+        self.models = importlib.import_module('models')
+        self.models.create_schema()
+        self.bot = importlib.import_module('bot')
+        self.webhook = importlib.import_module('webhook')
+        self.webhook.create_app()
+        import stripe
+        stripe.api_base = self.fakes['stripe'].url
+
+    def seed_users(self, count):
+        ids = [next(self._user_ids) for _ in range(count)]
+        until = datetime.utcnow() + timedelta(days=30)
+        with self.models.Session() as session:
+            session.add_all(self.models.User(telegram_id=str(user_id), subscription_status='active',
+                                             billing_period='monthly', subscribed_until=until) for user_id in ids)
+            session.commit()
+        return ids
+
+    # -- update builders -------------------------------------------------
+
+    def _base(self, user_id):
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'bench{user_id}'}
+        return {'message_id': next(self._update_ids), 'date': int(time.time()), 'from': user,
+                'chat': {'id': user_id, 'type': 'private'}}
+
+    def start_update(self, user_id):
+        message = dict(self._base(user_id), text='/start',
+                       entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def text_update(self, user_id):
+        return {'update_id': next(self._update_ids),
+                'message': dict(self._base(user_id), text=random.choice(['hey!', 'what are we doing today?',
+                                                                        'I got a new dog', 'it is so hot out']))}
+
+    def voice_update(self, user_id):
+        voice = {'file_id': f'voice{user_id}', 'file_unique_id': f'voice{user_id}', 'duration': 3,
+                 'mime_type': 'audio/ogg'}
+        return {'update_id': next(self._update_ids), 'message': dict(self._base(user_id), voice=voice)}
+
+    def checkout_update(self, user_id):
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'bench{user_id}'}
+        tier = random.choice(['daily', 'monthly', 'bi-annually', 'annually'])
+        query = {'id': str(next(self._update_ids)), 'from': user, 'chat_instance': str(user_id),
+                 'data': f'checkout-{tier}', 'message': dict(self._base(user_id), text='Please choose your membership tier:')}
+        return {'update_id': next(self._update_ids), 'callback_query': query}
+
+    # -- scenarios -------------------------------------------------------
+
+    async def deliver(self, raw_update, chat_id):
+        from telegram import Update
+        waiter = self.fakes['telegram'].waiter(chat_id)
+        started = time.perf_counter()
+        await self.application.update_queue.put(Update.de_json(raw_update, self.application.bot))
+        finished = await asyncio.wait_for(waiter, self.args.timeout)
+        return finished - started
+
+    async def idle_user(self):
+        if self._idle_users.empty():
+            # Every warmed-up user is busy, so bring a new one into the conversation first.
+            user_id = self.seed_users(1)[0]
+            await self.deliver(self.start_update(user_id), user_id)
+            return user_id
+        return self._idle_users.get_nowait()
+
+    async def run_text(self):
+        user_id = await self.idle_user()
+        try:
+            return await self.deliver(self.text_update(user_id), user_id)
+        finally:
+            self._idle_users.put_nowait(user_id)
+
+    async def run_voice(self):
+        user_id = await self.idle_user()
+        try:
+            return await self.deliver(self.voice_update(user_id), user_id)
+        finally:
+            self._idle_users.put_nowait(user_id)
+
+    async def run_start(self):
+        user_id = next(self._user_ids)
+        latency = await self.deliver(self.start_update(user_id), user_id)
+        self._idle_users.put_nowait(user_id)
+        return latency
+
+    async def run_checkout(self):
+        # Warmed-up users tap tiers repeatedly, so later taps can reuse their links.
+        user_id = await self.idle_user()
+        try:
+            return await self.deliver(self.checkout_update(user_id), user_id)
+        finally:
+            self._idle_users.put_nowait(user_id)
+
+    async def run_stripe(self):
+        telegram_id = random.randrange(FIRST_USER_ID, next(self._user_ids))
+        event_id = f"evt_bench_{next(self._update_ids)}"
+        if random.random() < 0.7:
+            event = {'id': event_id, 'object': 'event', 'type': 'checkout.session.completed', 'created': int(time.time()),
+                     'data': {'object': {'id': f'cs_{event_id}', 'object': 'checkout.session',
+                                         'customer': f'cus_{telegram_id}', 'subscription': f'sub_bench_{telegram_id}',
+                                         'metadata': {'telegram_id': str(telegram_id), 'billing_period': 'monthly'}}}}
+        else:
+            event = {'id': event_id, 'object': 'event', 'type': 'charge.succeeded', 'created': int(time.time()),
+                     'data': {'object': {'id': f'ch_{event_id}', 'object': 'charge', 'customer': f'cus_{telegram_id}',
+                                         'invoice': f'in_{telegram_id}', 'metadata': {}}}}
+        body = json.dumps(event)
+
+        def post():
+            started = time.perf_counter()
+            response = self.webhook.app.test_client().post('/stripe_webhook', data=body,
+                                                            content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f"webhook answered {response.status_code}")
+            return time.perf_counter() - started
+
+        return await asyncio.to_thread(post)
+
+    async def one(self, scenario):
+        try:
+            latency = await getattr(self, f'run_{scenario}')()
+        except Exception as e:
+            self.errors[scenario] += 1
+            if self.args.verbose:
+                print(f"{scenario} failed: {e!r}", file=sys.stderr)
+        else:
+            self.latencies[scenario].append(latency)
+
+    async def sample_memory(self):
+        while True:
+            self._rss_peak = max(self._rss_peak, rss_bytes())
+            await asyncio.sleep(0.25)
+
+    async def run(self):
+        args = self.args
+        self.application = self.bot.buildApplication(updater=False)
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+
+        for user_id in self.seed_users(args.warm_users):
+            await self.deliver(self.start_update(user_id), user_id)
+            self._idle_users.put_nowait(user_id)
+        for fake in self.fakes.values():
+            fake.behaviour.error_rate = args.error_rate
+
+        names, weights = zip(*args.mix.items())
+        total = int(args.rate * args.duration)
+        rss_start = rss_bytes()
+        sampler = asyncio.create_task(self.sample_memory())
+        tasks = []
+        started = time.perf_counter()
+        for index in range(total):
+            # Open-loop arrivals: requests keep coming on schedule even when the bot falls behind.
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.one(random.choices(names, weights)[0])))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        drain_started = time.perf_counter()
+        await asyncio.to_thread(self.webhook.event_queue.join)
+        drain = time.perf_counter() - drain_started
+        sampler.cancel()
+
+        await self.application.stop()
+        await self.application.shutdown()
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+
+        return self.report(total, elapsed, drain, rss_start)
+
+    def report(self, total, elapsed, drain, rss_start):
+        completed = sum(len(values) for values in self.latencies.values())
+        result = {
+            'requests': total,
+            'completed': completed,
+            'errors': sum(self.errors.values()),
+            'elapsed_s': elapsed,
+            'throughput_rps': completed / elapsed if elapsed else 0.0,
+            'stripe_queue_drain_s': drain,
+            'rss_start_mb': rss_start / 2 ** 20,
+            'rss_peak_mb': max(self._rss_peak, rss_start) / 2 ** 20,
+            'rss_end_mb': rss_bytes() / 2 ** 20,
+            'scenarios': {},
+            'upstream_calls': {name: dict(fake.calls) for name, fake in self.fakes.items()},
+        }
+        for scenario in SCENARIOS:
+            values = self.latencies.get(scenario, [])
+            if not values and not self.errors.get(scenario):
+                continue
+            result['scenarios'][scenario] = {
+                'ok': len(values),
+                'errors': self.errors.get(scenario, 0),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': max(values) * 1000 if values else float('nan'),
+            }
+        return result
+
+
+def print_report(result):
+    print(f"{result['completed']}/{result['requests']} requests in {result['elapsed_s']:.1f}s "
+          f"({result['throughput_rps']:.1f} req/s), {result['errors']} errors")
+    print(f"{'scenario':<8} {'ok':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in result['scenarios'].items():
+        print(f"{name:<8} {row['ok']:>6} {row['errors']:>5} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}")
+    print(f"stripe queue drained {result['stripe_queue_drain_s']:.2f}s after the last request")
+    print(f"rss: start {result['rss_start_mb']:.1f} MB, peak {result['rss_peak_mb']:.1f} MB, "
+          f"end {result['rss_end_mb']:.1f} MB")
+    for name, calls in result['upstream_calls'].items():
+        print(f"{name} calls: " + ", ".join(f"{call}={count}" for call, count in sorted(calls.items())))
+
+
+async def main_async(args):
+    fakes = {
+        'telegram': FakeTelegram(behaviour(args, 'telegram')),
+        'openai': FakeOpenAI(behaviour(args, 'openai')),
+        'tts': FakeElevenLabs(behaviour(args, 'tts')),
+        'stripe': FakeStripe(behaviour(args, 'stripe')),
+    }
+    for fake in fakes.values():
+        await fake.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='customfriend-bench-', ignore_cleanup_errors=True) as workdir:
+            configure_environment(args, fakes, workdir)
+            test = LoadTest(args, fakes)
+            test.setup()
+            return await test.run()
+    finally:
+        for fake in fakes.values():
+            await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the bot and the Stripe webhook.")
+    parser.add_argument('--rate', type=float, default=20, help="requests per second")
+    parser.add_argument('--duration', type=float, default=15, help="seconds of load")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('text=60,voice=15,start=10,stripe=15'))
+    parser.add_argument('--latency', type=float, default=0.05, help="default fake upstream latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of upstream calls that fail")
+    for service in ('telegram', 'openai', 'tts', 'stripe'):
+        parser.add_argument(f'--{service}-latency', type=float, help=f"override latency for the {service} fake")
+    parser.add_argument('--openai-slow-rate', type=float, default=0.0,
+                        help="share of OpenAI calls that take --openai-slow-latency longer")
+    parser.add_argument('--openai-slow-latency', type=float, default=2.0)
+    parser.add_argument('--hedge-budget', type=float, default=0.05,
+                        help="LLM_HEDGE_BUDGET for the bot; 0 disables hedged requests")
+    parser.add_argument('--warm-users', type=int, default=50, help="users taken through /start before measuring")
+    parser.add_argument('--coalesce-window', type=float, default=0.0)
+    parser.add_argument('--no-stream', dest='stream', action='store_false')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--database-url', help="use this database instead of a throwaway SQLite file")
+    parser.add_argument('--json', metavar='PATH', help="also write the results to PATH")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+    result = asyncio.run(main_async(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
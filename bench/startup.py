@@ -0,0 +1,159 @@
+"""Cold-start benchmark for bot.py.
+
+Starts a fresh interpreter per run against the fake Telegram from
+bench/fakes.py and an empty SQLite file, then reports how long each phase
+takes until the bot is ready to take updates: importing bot.py, building the
+Application, and initialize() plus post_init. Run from the repository root:
+
+    python -m bench.startup --runs 10 --imports 15
+
+The schema is created once up front, as `python models.py` does on deploy;
+startup itself only reads the persisted conversation state, which is empty.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+from bench.fakes import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ('interpreter', 'import', 'build', 'initialize', 'ready')
+
+# Runs in the child interpreter. Kept free of imports beyond the standard
+# library so that only bot.py's own imports are measured.
+CHILD = """
+import time
+started = time.perf_counter()
+import json, asyncio
+import bot
+imported = time.perf_counter()
+application = bot.buildApplication()
+built = time.perf_counter()
+
+async def run():
+    await application.initialize()
+    await application.post_init(application)
+    ready = time.perf_counter()
+    print(json.dumps({'started': started, 'import': imported - started, 'build': built - imported,
+                      'initialize': ready - built}), flush=True)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+asyncio.run(run())
+"""
+
+
+def child_environment(telegram_url, workdir):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+        'TELEGRAM_TOKEN': '123456:bench',
+        'TELEGRAM_API_BASE': telegram_url,
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts'),
+        'SWEEP_INTERVAL': '0',
+        'METRICS_PORT': '0',
+    })
+    return env
+
+
+async def measure_once(env):
+    spawned = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', CHILD, env=env, cwd=ROOT,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    line = await process.stdout.readline()
+    ready = time.perf_counter()
+    _, stderr = await process.communicate()
+    if not line:
+        raise RuntimeError(f"bot did not start:\n{stderr.decode(errors='replace')}")
+    timings = json.loads(line)
+    # perf_counter is system-wide on Linux and macOS, so the child's start
+    # time can be compared with the moment the parent spawned it.
+    return {
+        'interpreter': timings['started'] - spawned,
+        'import': timings['import'],
+        'build': timings['build'],
+        'initialize': timings['initialize'],
+        'ready': ready - spawned,
+    }
+
+
+async def import_profile(env, limit):
+    """Top-level modules bot.py pulls in, by cumulative import time."""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-X', 'importtime', '-c', 'import bot', env=env, cwd=ROOT,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    modules = []
+    for line in stderr.decode(errors='replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Direct imports of bot.py are indented by exactly three spaces.
+        if name.startswith('   ') and not name.startswith('    '):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    modules.sort(key=lambda item: item[1], reverse=True)
+    return modules[:limit]
+
+
+async def main_async(args):
+    telegram = await FakeTelegram().start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='customfriend-startup-', ignore_cleanup_errors=True) as workdir:
+            env = child_environment(telegram.url, workdir)
+            schema = await asyncio.create_subprocess_exec(sys.executable, 'models.py', env=env, cwd=ROOT,
+                                                          stdout=asyncio.subprocess.DEVNULL)
+            await schema.wait()
+            # One unmeasured run so the page cache and .pyc files are warm.
+            await measure_once(env)
+            runs = [await measure_once(env) for _ in range(args.runs)]
+            imports = await import_profile(env, args.imports) if args.imports else []
+    finally:
+        await telegram.stop()
+
+    result = {'runs': args.runs, 'phases': {}, 'imports': [{'module': name, 'seconds': seconds}
+                                                          for name, seconds in imports]}
+    for phase in PHASES:
+        values = [run[phase] for run in runs]
+        result['phases'][phase] = {
+            'median_ms': statistics.median(values) * 1000,
+            'min_ms': min(values) * 1000,
+            'max_ms': max(values) * 1000,
+        }
+    return result
+
+
+def print_report(result):
+    print(f"{result['runs']} cold starts")
+    print(f"{'phase':<12} {'median ms':>10} {'min ms':>9} {'max ms':>9}")
+    for phase, row in result['phases'].items():
+        print(f"{phase:<12} {row['median_ms']:>10.1f} {row['min_ms']:>9.1f} {row['max_ms']:>9.1f}")
+    if result['imports']:
+        print("slowest imports of bot.py:")
+        for entry in result['imports']:
+            print(f"  {entry['module']:<28} {entry['seconds'] * 1000:>8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long bot.py takes to become ready.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=10, metavar='N',
+                        help="also list the N slowest direct imports of bot.py (0 to skip)")
+    parser.add_argument('--json', metavar='PATH', help="also write the results to PATH")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,51 @@
 import logging
 import os
-import openai
-import requests
+import asyncio
 from io import BytesIO
 from dotenv import load_dotenv
-from telegram import *
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, ConversationHandler, 
     MessageHandler, filters, ContextTypes
 )
-from models import Session, User
-from playsound import playsound
-import datetime
-from datetime import timedelta
-import pytz
-import stripe
-from dateutil.relativedelta import relativedelta
-import uuid
+from models import AsyncSession, async_engine, upsert_user
+from clients import close_session
+from llm import transcribe, preload as preloadOpenAI
+from llmrouter import router
+from streaming import MessageStreamer
+from entitlements import EntitlementCache, start_invalidation_listener
+from voice import download_voice, synthesize
+from audio import ogg_duration, prepare_for_transcription
+from memory import CONTEXT_TOKEN_BUDGET, ConversationMemory, count_tokens, load_encoding
+from personas import PersonaRegistry
+from sweeper import SWEEP_INTERVAL, expire_lapsed_subscriptions
+from coalesce import BurstCoalescer
+from checkout import CheckoutCache
+from persistence import DatabasePersistence
+from broadcast import AUDIENCES, create_broadcast, recent_broadcasts, run_broadcast, running_broadcasts, set_status
+from admission import AdmissionRejected, RateLimiter, current_priority, HIGHEST_PRIORITY, DEFAULT_PRIORITY
+from observability import counter, setup_logging, start_metrics_server, timed_handler
 
 
 
 
 
 
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
-ELEVEN = os.getenv("ELEVEN_LABS_API_KEY")
-stripe.api_key = STRIPE_SECRET_KEY
-openai.api_key = os.getenv('OPENAI_KEY')
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_PORT = int(os.getenv("WORKER_PORT", 8100))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
 
 STRIPE_PRICES = {
     'daily': 'price_1Nbya7LsuI4Zz7zgmUzyBII1', 
@@ -45,17 +55,38 @@ STRIPE_PRICES = {
 }
 
 WHITELISTED_IDS = set()
+entitlements = EntitlementCache(WHITELISTED_IDS)
+memory = ConversationMemory()
+personas = PersonaRegistry()
+rateLimiter = RateLimiter()
+coalescer = BurstCoalescer()
+checkouts = CheckoutCache()
+# Longer billing periods are served first; STRIPE_PRICES lists them shortest first.
+TIER_PRIORITY = {tier: index + 1 for index, tier in enumerate(reversed(STRIPE_PRICES))}
 ADMIN_USER_ID = 1402836486
 
-friend, customizefriend = range(2)
+BUSY_MESSAGE = "I'm swamped right now, please try again in a minute."
+FAILURE_MESSAGE = "Sorry, I couldn't come up with a reply. Please try again."
+rateLimited = counter('rate_limited_total', 'Messages dropped by the per-user rate limit')
+
+# Conversation states; persisted, so plain ints rather than the handler
+# functions named friend and customizefriend.
+FRIEND, CUSTOMIZE_FRIEND = range(2)
 
 async def getId(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Your Telegram ID is {update.message.chat_id}")
 
 
 
+def isAdmin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id == ADMIN_USER_ID
+
+
 async def addw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.message.from_user.id
+    # Whitelisted users skip the rate limit, so only the admin may add anyone.
+    if not isAdmin(update):
+        return
+    user_id = int(context.args[0]) if context.args and context.args[0].isdigit() else update.message.from_user.id
     if user_id not in WHITELISTED_IDS:
         WHITELISTED_IDS.add(user_id)
         await update.message.reply_text("whitelisted")
@@ -63,30 +94,78 @@ async def addw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("already whitelisted")
 
 async def clearw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not isAdmin(update):
+            return
         WHITELISTED_IDS.clear()
         await update.message.reply_text("Whitelist cleared.")
 
 
+async def broadcastMessage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not isAdmin(update):
+        return
+    # Split the raw text so the announcement keeps its line breaks.
+    parts = update.message.text.split(None, 2)
+    if len(parts) < 3 or parts[1] not in AUDIENCES:
+        await update.message.reply_text(f"Usage: /broadcast <{'|'.join(AUDIENCES)}> <message>")
+        return
+    broadcast = await create_broadcast(parts[1], parts[2])
+    context.application.create_task(run_broadcast(context.bot, broadcast.id))
+    await update.message.reply_text(f"Broadcast {broadcast.id} to {broadcast.audience} users started. "
+                                    "Check on it with /broadcaststatus.")
+
+
+async def broadcastStatus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not isAdmin(update):
+        return
+    broadcasts = await recent_broadcasts()
+    if not broadcasts:
+        await update.message.reply_text("No broadcasts yet.")
+        return
+    await update.message.reply_text("\n".join(
+        f"#{b.id} {b.audience}, {b.status}: {b.sent} sent, {b.failed} failed" for b in broadcasts
+    ))
+
+
+async def broadcastCancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not isAdmin(update):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: /broadcastcancel <id>")
+        return
+    if await set_status(int(context.args[0]), 'cancelled'):
+        await update.message.reply_text("Cancelled; it stops after the batch in flight.")
+    else:
+        await update.message.reply_text("No running broadcast with that id.")
+
+
 async def isUserAllowed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user_id = update.effective_user.id
 
-    with Session() as session:
-        print(f"Fetching user with telegram_id: {user_id}") 
-        user = session.query(User).filter(User.telegram_id == str(user_id)).first()
-        print(f"Fetched user: {user}")  
-
-        if user and user.subscription_status == 'active':
-            print(f"User subscription status: {user.subscription_status}")  
-            return True
-        elif user_id in WHITELISTED_IDS:  
-            print(f"User in whitelist: {user_id in WHITELISTED_IDS}") 
-            return True
-        else:
-            await context.bot.send_message(
-                chat_id=user_id, 
-                text="Your subscription ended. Please use /checkout to renew your subscription."
-            )
-            return False
+    if await entitlements.is_allowed(user_id):
+        return True
+
+    await context.bot.send_message(
+        chat_id=user_id, 
+        text="Your subscription ended. Please use /checkout to renew your subscription."
+    )
+    return False
+
+
+async def admitRequest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # Rate-limits the user and sets the priority their AI calls queue with.
+    user_id = update.effective_user.id
+    if user_id in WHITELISTED_IDS:
+        current_priority.set(HIGHEST_PRIORITY)
+        return True
+
+    if not rateLimiter.allow(user_id):
+        rateLimited.inc()
+        await update.message.reply_text("You're sending messages a bit too fast. Give me a moment to catch up!")
+        return False
+
+    entitlement = await entitlements.lookup(user_id)
+    current_priority.set(TIER_PRIORITY.get(entitlement.billing_period, DEFAULT_PRIORITY))
+    return True
 
 
 
@@ -97,9 +176,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
 
-    if query.data == str(friend):
+    if query.data == 'friend':
         await friend(update, context)
-    elif query.data == str(customizefriend):
+    elif query.data == 'customizefriend':
         await customizefriend(update, context)
 
 async def askForMembershipTier(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -113,15 +192,14 @@ async def askForMembershipTier(update: Update, context: ContextTypes.DEFAULT_TYP
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text('Please choose your membership tier:', reply_markup=reply_markup)
 
+@timed_handler
 async def handleCheckout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Handling checkout...")
     if update.callback_query:
         query = update.callback_query 
         await query.answer()
 
-        billing_period = await query.data.replace('checkout-', '')
-
-        price_id = STRIPE_PRICES[billing_period]
+        billing_period = query.data.replace('checkout-', '')
         logger.info(f"Received callback_query with billing_period: {billing_period}")
 
     else:
@@ -129,55 +207,46 @@ async def handleCheckout(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.info(f"Using default/user stored billing_period: {billing_period}")
     price_id = STRIPE_PRICES[billing_period]
 
-
-
-    session = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        line_items=[{
-            'price': price_id,
-            'quantity': 1,
-        }],
-        mode='subscription',
-        success_url='https://t.me/AI_friend_bot?start=payment_success',
-        cancel_url='https://t.me/AI_friend_bot?start=payment_cancel',
-        metadata={
-            'telegram_id': str(update.effective_user.id)
-        }
-    )
-    
+    # Stripe runs on a worker thread, and a repeat tap reuses the unexpired link.
+    try:
+        url = await checkouts.url(update.effective_user.id, billing_period, price_id, STRIPE_SECRET_KEY)
+    except Exception as e:
+        logger.error(f"Could not create a checkout session for {update.effective_user.id}: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text="Sorry, the payment page isn't available right now. Please try again.")
+        return
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=f"Please complete your payment by clicking [here]({session.url}).",
+        text=f"Please complete your payment by clicking [here]({url}).",
         parse_mode=ParseMode.MARKDOWN
     )
 
 
 
 
-friend, customizefriend = range(2)
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.message.chat_id
-    
-    with Session() as session:
-        user = session.query(User).filter(User.telegram_id == str(user_id)).first()
-        
-        if not user: 
-            new_user = User(telegram_id=str(user_id))
-            session.add(new_user)
-            session.commit()
-            print(f"User with telegram_id {user_id} added to database")
+
+    # One round trip, and safe when the same user sends /start twice at once.
+    async with AsyncSession() as session:
+        result = await session.execute(upsert_user(async_engine, user_id))
+        await session.commit()
+    if result.rowcount:
+        logger.info("User with telegram_id %s added to database", user_id)
 
     keyboard = [
         [
-            InlineKeyboardButton("DefaultFriend", callback_data=str(friend)),
-            InlineKeyboardButton("CustomFriend", callback_data=str(customizefriend)),
+            InlineKeyboardButton("DefaultFriend", callback_data='friend'),
+            InlineKeyboardButton("CustomFriend", callback_data='customizefriend'),
         ]
     ]
     args = context.args
     if args:
         if args[0] == "payment_success":
+            checkouts.invalidate(user_id)
             await update.message.reply_text("Thank you for your payment!")
            
         elif args[0] == "payment_cancel":
@@ -186,7 +255,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text('Please choose:', reply_markup=reply_markup)
 
-    return friend
+    return FRIEND
 
 
 
@@ -197,142 +266,225 @@ async def friend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     await query.edit_message_text('You chose DefaultFriend!')
-    return friend
+    return FRIEND
 
 
 async def customizefriend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("Describe the traits you'd like your custom friend to have (e.g. shy, poetic, introspective)")
-    return customizefriend
+    return CUSTOMIZE_FRIEND
 
 async def getTraits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    traits = update.message.text
+    # Stored as compiled: normalized and capped to PERSONA_TRAIT_TOKENS.
+    traits = personas.get(update.message.text).traits
+    if not traits:
+        await update.message.reply_text("Tell me at least one trait, separated by commas.")
+        return CUSTOMIZE_FRIEND
     context.user_data['traits'] = traits
     await update.message.reply_text(f"Got it! friend will now have the traits: {traits}. You can chat with her now!")
     return ConversationHandler.END
 
+@timed_handler
 async def handleText(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not isUserAllowed(update, context):
+    if not await isUserAllowed(update, context) or not await admitRequest(update, context):
         return
-    user_message = update.message.text
+    # Quick follow-up messages are answered together; see coalesce.py.
+    coalescer.submit(
+        update.effective_chat.id,
+        update.message.text,
+        lambda text, burst: replyToText(update, context, text, burst),
+        # Tracked by the Application, so stop() waits for replies still in flight.
+        create_task=context.application.create_task,
+    )
+
+
+@timed_handler
+async def replyToText(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message, burst) -> None:
     traits = context.user_data.get('traits', '')
-    friend_response = getAIResponse(user_message, traits)
-    await update.message.reply_text(friend_response)
+    try:
+        if STREAM_REPLIES:
+            await streamAIResponse(update.message, user_message, traits, update.effective_user.id,
+                                   onFirstChunk=burst.commit)
+        else:
+            friend_response = await getAIResponse(user_message, traits, update.effective_user.id)
+            burst.commit()
+            await update.message.reply_text(friend_response)
+    except AdmissionRejected as e:
+        burst.commit()
+        logger.warning("Rejected AI request from %s: %s", update.effective_user.id, e)
+        await update.message.reply_text(BUSY_MESSAGE)
+    except Exception:
+        burst.commit()
+        logger.exception("AI request from %s failed", update.effective_user.id)
+        await update.message.reply_text(FAILURE_MESSAGE)
 
 
 
 
+@timed_handler
 async def handleVoice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    voice = update.message.voice
-    voice_file = await context.bot.get_file(voice.file_id)
-    file_path = voice_file.file_path
-
-
-    file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-    response = requests.get(file_url)
-
-    if response.status_code == 200:
-        with open('voice.ogg', 'wb') as f:
-            f.write(response.content)
-
-    with open('voice.ogg', 'rb') as f:
-        speechtotext = openai.Audio.transcribe("whisper-1", f)
-        print(speechtotext)
-    
-    transcribed_text = speechtotext['text'] 
-
-    friend_response = getAIResponse(transcribed_text)
-    
- 
-    payload = {
-        "text": friend_response,
-        "model_id": "eleven_monolingual_v1",
-        "voice_settings": {
-                "stability": 0,
-                "similarity_boost": 0
-        }
-    }
-    headers = {
-        'accept': 'audio/mpeg',
-        'xi-api-key': ELEVEN,
-        'Content-Type': 'application/json'  
-    }
-    
-    response = requests.post('https://api.elevenlabs.io/v1/text-to-speech/fkogAIAZGZ11v5ryG9tl', json=payload, headers=headers)
-
-
-    print("Status Code:", response.status_code)
-    print("Response:", response.text)
-
-    if response.status_code == 200 and response.content:
-        with open('audio.mp3', 'wb') as f:
-            f.write(response.content)
-            
-        with open('audio.mp3', 'rb') as audio:
-            await update.message.reply_voice(audio)
-
-            
+    if not await isUserAllowed(update, context) or not await admitRequest(update, context):
+        return
+    try:
+        voice_note = await download_voice(context.bot, update.message.voice.file_id)
+        voice_note = await prepare_for_transcription(voice_note)
+        if voice_note is None:
+            await update.message.reply_text("I couldn't hear anything in that voice message.")
+            return
+        transcribed_text = await transcribe(voice_note)
+        logger.info("Transcribed voice message: %s", transcribed_text)
+
+        friend_response = await getAIResponse(transcribed_text, user_id=update.effective_user.id)
+        audio = await synthesize(friend_response)
+    except AdmissionRejected as e:
+        logger.warning("Rejected AI request from %s: %s", update.effective_user.id, e)
+        await update.message.reply_text(BUSY_MESSAGE)
+        return
+
+    if audio:
+        duration = ogg_duration(audio)
+        await update.message.reply_voice(BytesIO(audio), duration=round(duration) if duration else None)
     else:
         await update.message.reply_text("Sorry, I couldn't convert my response to audio.")
 
 
 
-def getAIResponse(user_message, traits=""):
-    if traits:
-        system_message_content = f"lets roleplay. you will play the role of 'Jamie' you will start every conversation with 'Jamie' your main goal is to help me and have fun as Jamie. Jamie doesn't have any friends besides me. Jamie doesn't see his family much because they are out of state. Jamie doesn't have a significant other. Jamie is always down to hang out with me no matter what it is. Jamie is a nice chiasmatic guy. Jamie loves dogs, ice-cream, and hanging out with me. Jamie hates the heat. if you understand you objectives and what Jamies like ask me what we are doing in this current situation. JAMIES PERSONALITY TRAITS ARE: {traits}"
-
-    else:
-        system_message_content = "lets roleplay. you will play the role of 'Jamie' you will start every conversation with 'CustomFriend:' your main goal is to help me and have fun as Jamie. Jamie doesn't have any friends besides me. Jamie doesn't see his family much because they are out of state. Jamie doesn't have a significant other. Jamie is always down to hang out with me no matter what it is. Jamie is a nice chiasmatic guy. Jamie loves dogs, ice-cream, and hanging out with me. Jamie hates the heat. if you understand you objectives and what Jamies like ask me what we are doing in this current situation."
-        
-        
-    response = openai.ChatCompletion.create(
-      model="gpt-3.5-turbo",
-      messages=[
+def buildPrompt(user_message, traits="", conversation=None):
+    # Compiled once per distinct set of traits, token count included; see
+    # personas.py. The history gets what is left of the budget.
+    compiled = personas.get(traits)
+    budget = CONTEXT_TOKEN_BUDGET - compiled.tokens - count_tokens(user_message)
+    history = conversation.context_messages(max(0, budget)) if conversation else []
+    return [
         {
             "role": "system",
-            "content": system_message_content
+            "content": compiled.system_prompt
         },
+        *history,
         {
             "role": "user",
             "content": user_message
         }
-      ]
-    )
+    ]
+
 
-    gpt3_response = response['choices'][0]['message']['content'].strip()
+async def getAIResponse(user_message, traits="", user_id=None):
+    conversation = await memory.get(user_id) if user_id else None
+    gpt3_response = await router.complete(buildPrompt(user_message, traits, conversation))
+    if conversation:
+        memory.record(conversation, user_message, gpt3_response)
     return f"{gpt3_response}"
 
 
+async def streamAIResponse(message: Message, user_message, traits="", user_id=None, onFirstChunk=None):
+    conversation = await memory.get(user_id) if user_id else None
+    streamer = MessageStreamer(message)
+    try:
+        async for chunk in router.stream(buildPrompt(user_message, traits, conversation)):
+            if onFirstChunk:
+                onFirstChunk()
+                onFirstChunk = None
+            await streamer.feed(chunk)
+    finally:
+        text = await streamer.finish()
+    if conversation and text:
+        memory.record(conversation, user_message, text)
+    return text
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     logger.info("User %s canceled the conversation.", user.first_name)
     await update.message.reply_text('Bye! I hope we can talk again some day.')
 
     return ConversationHandler.END
-def main() -> None:
-    """Start the bot."""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+
+async def sweepSubscriptions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    expired = await asyncio.to_thread(expire_lapsed_subscriptions)
+    logger.info("Expired %d lapsed subscriptions", len(expired))
+
+def preloadSDKs() -> None:
+    preloadOpenAI()
+    load_encoding()
+
+async def resumeBroadcasts(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Broadcasts still marked running were interrupted by a restart.
+    for broadcast_id in await running_broadcasts():
+        logger.info("Resuming broadcast %s", broadcast_id)
+        context.application.create_task(run_broadcast(context.bot, broadcast_id))
+
+async def startup(application: Application) -> None:
+    loop = asyncio.get_running_loop()
+    # The whitelist lives in bot_data so it is persisted; keep using the one
+    # set object that the entitlement cache also holds.
+    WHITELISTED_IDS.update(application.bot_data.get('whitelist', ()))
+    application.bot_data['whitelist'] = WHITELISTED_IDS
+    start_invalidation_listener(entitlements, loop)
+    # The heavy SDKs are imported lazily; pull them in on a thread now so the
+    # bot takes updates right away and the first reply doesn't pay for them.
+    loop.run_in_executor(None, preloadSDKs)
+    # With several webhook workers only the first one runs the sweep.
+    if application.job_queue and SWEEP_INTERVAL and WORKER_INDEX == 0:
+        application.job_queue.run_repeating(sweepSubscriptions, interval=SWEEP_INTERVAL, first=60)
+    if application.job_queue and WORKER_INDEX == 0:
+        application.job_queue.run_once(resumeBroadcasts, when=5)
+
+async def shutdown(application: Application) -> None:
+    await memory.flush()
+    await close_session()
+    await async_engine.dispose()
+
+def buildApplication(updater: bool = True) -> Application:
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+        .concurrent_updates(True)
+        .persistence(DatabasePersistence())
+        .post_init(startup)
+        .post_shutdown(shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            friend: [MessageHandler(filters.TEXT & ~filters.COMMAND, handleText), 
+            FRIEND: [MessageHandler(filters.TEXT & ~filters.COMMAND, handleText), 
                    MessageHandler(filters.VOICE, handleVoice)],
-            customizefriend: [MessageHandler(filters.TEXT & ~filters.COMMAND, getTraits)],
+            CUSTOMIZE_FRIEND: [MessageHandler(filters.TEXT & ~filters.COMMAND, getTraits)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='conversation',
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
-    # application.add_handler(CommandHandler('checkout', askForMembershipTier))
-    # application.add_handler(CallbackQueryHandler(handleCheckout, pattern='^checkout-.*$'))
+    application.add_handler(CommandHandler('checkout', askForMembershipTier))
+    application.add_handler(CallbackQueryHandler(handleCheckout, pattern='^checkout-.*$'))
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(CommandHandler('getId', getId))
     application.add_handler(CommandHandler("addw", addw))
     application.add_handler(CommandHandler("clearw", clearw))
+    application.add_handler(CommandHandler("broadcast", broadcastMessage))
+    application.add_handler(CommandHandler("broadcaststatus", broadcastStatus))
+    application.add_handler(CommandHandler("broadcastcancel", broadcastCancel))
+    return application
 
-    application.run_polling()
+def main() -> None:
+    """Start the bot."""
+    if BOT_MODE == 'worker':
+        # Webhook mode: tgrouter.py receives updates and forwards each chat to
+        # one worker process, which runs here.
+        from tgrouter import run_worker
+        asyncio.run(run_worker(buildApplication(updater=False), port=WORKER_PORT))
+    else:
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        buildApplication().run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,214 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from models import AsyncSession, Broadcast, User
+from admission import TokenBucket
+from observability import counter
+
+logger = logging.getLogger(__name__)
+
+# Telegram lets a bot send about 30 messages per second in total, and live
+# replies and streamed edits count toward that too; the broadcast only takes
+# part of it so the rest stays free for chat.
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 10))
+# Users are read and sent to this many at a time; progress is saved after each batch.
+BROADCAST_BATCH = int(os.getenv('BROADCAST_BATCH', 200))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', 4))
+EXPIRING_WITHIN_DAYS = int(os.getenv('EXPIRING_WITHIN_DAYS', 3))
+
+AUDIENCES = ('all', 'active', 'expiring')
+
+_messages = counter('broadcast_messages_total', 'Broadcast messages by outcome')
+
+
+def audience_filter(audience, now=None):
+    """WHERE clauses selecting the users a broadcast goes to."""
+    now = now or datetime.utcnow()
+    if audience == 'all':
+        return []
+    if audience == 'active':
+        return [User.subscription_status == 'active']
+    if audience == 'expiring':
+        return [User.subscription_status == 'active',
+                User.subscribed_until >= now,
+                User.subscribed_until < now + timedelta(days=EXPIRING_WITHIN_DAYS)]
+    raise ValueError(f"unknown audience {audience!r}; expected one of {', '.join(AUDIENCES)}")
+
+
+class RateLimitedSender:
+    """Sends messages no faster than `rate` per second across all chats.
+
+    Only broadcast sends are counted; replies to users share Telegram's limit
+    but not this bucket, which is why the default rate leaves headroom.
+
+    A RetryAfter from Telegram pauses every send, not only the one that got
+    it, because flood control applies to the bot as a whole. Network errors
+    are retried with exponential backoff; users who blocked the bot or whose
+    chat is gone are skipped.
+    """
+
+    def __init__(self, bot, rate=BROADCAST_RATE, max_attempts=BROADCAST_MAX_ATTEMPTS):
+        self.bot = bot
+        self.rate = rate
+        self.max_attempts = max_attempts
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.paused_until = 0.0
+
+    async def _wait_turn(self):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            elif self.bucket.take():
+                return
+            else:
+                await asyncio.sleep(1 / self.rate)
+
+    async def send(self, chat_id, text) -> bool:
+        for attempt in range(self.max_attempts):
+            await self._wait_turn()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                _messages.inc(outcome='sent')
+                return True
+            except RetryAfter as e:
+                logger.info("Broadcast throttled by Telegram, pausing for %ss", e.retry_after)
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                logger.info("Skipping chat %s: %s", chat_id, e)
+                _messages.inc(outcome='undeliverable')
+                return False
+            except NetworkError as e:
+                logger.warning("Sending to chat %s failed (attempt %d): %s", chat_id, attempt + 1, e)
+                await asyncio.sleep(min(30, 2 ** attempt))
+        _messages.inc(outcome='failed')
+        return False
+
+
+async def create_broadcast(audience, text):
+    audience_filter(audience)  # reject unknown audiences before anything is stored
+    async with AsyncSession() as session:
+        broadcast = Broadcast(audience=audience, text=text, status='running', last_user_id=0, sent=0, failed=0)
+        session.add(broadcast)
+        await session.commit()
+        return broadcast
+
+
+async def set_status(broadcast_id, status):
+    async with AsyncSession() as session:
+        result = await session.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == 'running').values(status=status)
+        )
+        await session.commit()
+    return result.rowcount > 0
+
+
+async def _checkpoint(broadcast_id, last_user_id, sent, failed):
+    # Everything up to last_user_id has been handled. Returns the stored
+    # status so a cancel issued meanwhile stops the run.
+    async with AsyncSession() as session:
+        status = await session.scalar(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(last_user_id=last_user_id, sent=Broadcast.sent + sent, failed=Broadcast.failed + failed)
+            .returning(Broadcast.status)
+        )
+        await session.commit()
+    return status
+
+
+async def run_broadcast(bot, broadcast_id, sender=None):
+    """Send broadcast `broadcast_id`, picking up after its last checkpoint.
+
+    Users are read in id order, BROADCAST_BATCH at a time, each batch
+    starting after the last id handled, so memory stays flat however many
+    users there are and no transaction is held open while messages go out.
+    Progress is saved after every batch; if the process stops, running this
+    again resends at most the batch that was in flight.
+    """
+    sender = sender or RateLimitedSender(bot)
+    async with AsyncSession() as session:
+        broadcast = await session.get(Broadcast, broadcast_id)
+    if broadcast is None or broadcast.status != 'running':
+        return broadcast
+    logger.info("Broadcast %s to %s users starting after user id %s",
+                broadcast_id, broadcast.audience, broadcast.last_user_id)
+
+    last_user_id = broadcast.last_user_id
+    filters = audience_filter(broadcast.audience)
+    while True:
+        async with AsyncSession() as session:
+            batch = (await session.execute(
+                select(User.id, User.telegram_id)
+                .where(User.id > last_user_id, *filters)
+                .order_by(User.id)
+                .limit(BROADCAST_BATCH)
+            )).all()
+        if not batch:
+            break
+        delivered = sum(await asyncio.gather(*(sender.send(telegram_id, broadcast.text)
+                                               for _, telegram_id in batch)))
+        last_user_id = batch[-1].id
+        status = await _checkpoint(broadcast_id, last_user_id, delivered, len(batch) - delivered)
+        if status != 'running':
+            logger.info("Broadcast %s stopped: %s", broadcast_id, status)
+            return await _reload(broadcast_id)
+
+    await set_status(broadcast_id, 'done')
+    broadcast = await _reload(broadcast_id)
+    logger.info("Broadcast %s done: %s sent, %s failed", broadcast_id, broadcast.sent, broadcast.failed)
+    return broadcast
+
+
+async def _reload(broadcast_id):
+    async with AsyncSession() as session:
+        return await session.get(Broadcast, broadcast_id)
+
+
+async def running_broadcasts():
+    async with AsyncSession() as session:
+        return (await session.scalars(select(Broadcast.id).where(Broadcast.status == 'running'))).all()
+
+
+async def recent_broadcasts(limit=5):
+    async with AsyncSession() as session:
+        return (await session.scalars(select(Broadcast).order_by(Broadcast.id.desc()).limit(limit))).all()
+
+
+async def _main(args):
+    from telegram import Bot
+
+    api_base = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+    async with Bot(os.getenv('TELEGRAM_TOKEN'), base_url=f"{api_base}/bot") as bot:
+        if args.resume:
+            broadcast_id = args.resume
+        else:
+            broadcast_id = (await create_broadcast(args.audience, args.text)).id
+            print(f"Created broadcast {broadcast_id}")
+        broadcast = await run_broadcast(bot, broadcast_id)
+    if broadcast is None:
+        print(f"No broadcast {broadcast_id}")
+    else:
+        print(f"Broadcast {broadcast.id} {broadcast.status}: {broadcast.sent} sent, {broadcast.failed} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a message to every user in an audience, or resume a broadcast.")
+    parser.add_argument('--audience', choices=AUDIENCES, default='active')
+    parser.add_argument('--resume', type=int, metavar='ID', help="continue an interrupted broadcast")
+    parser.add_argument('text', nargs='?', help="message to send")
+    args = parser.parse_args()
+    if not args.resume and not args.text:
+        parser.error("give the message text, or --resume ID")
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from observability import counter, timed
+
+logger = logging.getLogger(__name__)
+
+# How long a checkout link stays valid; Stripe accepts 30 minutes to 24 hours.
+CHECKOUT_TTL = int(os.getenv('CHECKOUT_TTL', 3600))
+CHECKOUT_CACHE_SIZE = int(os.getenv('CHECKOUT_CACHE_SIZE', 10000))
+# A cached link is not handed out in its last few minutes, so the user has
+# time to finish paying before Stripe expires the session.
+CHECKOUT_EXPIRY_MARGIN = 300
+CHECKOUT_SUCCESS_URL = os.getenv('CHECKOUT_SUCCESS_URL', 'https://t.me/AI_friend_bot?start=payment_success')
+CHECKOUT_CANCEL_URL = os.getenv('CHECKOUT_CANCEL_URL', 'https://t.me/AI_friend_bot?start=payment_cancel')
+
+_checkouts = counter('checkout_sessions_total', 'Checkout links handed out, by where they came from')
+
+
+def create_checkout_session(telegram_id, billing_period, price_id, api_key):
+    """Blocking Stripe call; returns (url, expires_at as a Unix time)."""
+    import stripe
+
+    with timed('stripe_api_seconds', 'Stripe API latency', call='checkout.Session.create'):
+        session = stripe.checkout.Session.create(
+            api_key=api_key,
+            payment_method_types=['card'],
+            line_items=[{
+                'price': price_id,
+                'quantity': 1,
+            }],
+            mode='subscription',
+            success_url=CHECKOUT_SUCCESS_URL,
+            cancel_url=CHECKOUT_CANCEL_URL,
+            expires_at=int(time.time()) + CHECKOUT_TTL,
+            metadata={
+                'telegram_id': str(telegram_id),
+                'billing_period': billing_period
+            }
+        )
+    return session.url, session.expires_at
+
+
+class CheckoutCache:
+    """Per-process cache of unexpired checkout links by (telegram_id, billing_period).
+
+    Sessions are created on a worker thread so the Stripe round trip never
+    blocks the event loop. A user tapping the same tier again gets the link
+    they already have, and taps that arrive while a session is still being
+    created wait for that one instead of creating another.
+    """
+
+    def __init__(self, maxsize=CHECKOUT_CACHE_SIZE, create=create_checkout_session):
+        self.maxsize = maxsize
+        self.create = create
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        url, expires = entry
+        if expires - CHECKOUT_EXPIRY_MARGIN < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return url
+
+    def put(self, key, url, expires):
+        self._entries[key] = (url, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        # A completed session's link is useless, so drop all of a user's
+        # links once they have paid.
+        for key in [key for key in self._entries if key[0] == str(telegram_id)]:
+            del self._entries[key]
+
+    async def url(self, telegram_id, billing_period, price_id, api_key):
+        key = (str(telegram_id), billing_period)
+        url = self.get(key)
+        if url is not None:
+            _checkouts.inc(source='cache')
+            return url
+        task = self._pending.get(key)
+        if task is not None:
+            _checkouts.inc(source='pending')
+        else:
+            _checkouts.inc(source='stripe')
+            task = self._pending[key] = asyncio.ensure_future(asyncio.to_thread(
+                self.create, telegram_id, billing_period, price_id, api_key))
+            task.add_done_callback(lambda done: self._finished(key, done))
+        # Shielded so a cancelled tap doesn't cancel the session others are waiting on.
+        url, _ = await asyncio.shield(task)
+        return url
+
+    def _finished(self, key, task):
+        del self._pending[key]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, *task.result())
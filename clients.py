@@ -0,0 +1,42 @@
+import os
+import asyncio
+from typing import TYPE_CHECKING
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    import aiohttp
+
+load_dotenv()
+
+# One pooled, keep-alive session is shared by every outbound API call the bot
+# makes, so concurrent conversations reuse connections instead of opening a
+# new TLS handshake per request.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 100))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 50))
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', 30))
+
+_session = None
+_session_lock = asyncio.Lock()
+
+
+async def get_session() -> 'aiohttp.ClientSession':
+    global _session
+    if _session is None or _session.closed:
+        async with _session_lock:
+            if _session is None or _session.closed:
+                # Imported here rather than at module level to keep bot startup fast.
+                import aiohttp
+                connector = aiohttp.TCPConnector(
+                    limit=HTTP_POOL_SIZE,
+                    limit_per_host=HTTP_POOL_PER_HOST,
+                    keepalive_timeout=HTTP_KEEPALIVE,
+                )
+                _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,70 @@
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Every message waits this long before the LLM is called, so it adds directly
+# to time to first token. Kept short: a follow-up that arrives later still
+# cancels the stale call and is answered together with the first message.
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 0.15))
+
+
+class Burst:
+    """Messages from one chat that will be answered together."""
+
+    def __init__(self):
+        self.messages = []
+        self.respond = None
+        self.task = None
+        self.committed = False
+
+    def commit(self):
+        # Called by the responder right before it sends anything. From then on
+        # a newer message starts a new burst instead of cancelling this one.
+        self.committed = True
+
+    @property
+    def text(self):
+        return "\n".join(self.messages)
+
+
+class BurstCoalescer:
+    """Per-chat debounce in front of the LLM.
+
+    Each message restarts a `window`-second timer for its chat. When the timer
+    runs out, `respond(text, burst)` is called once with all collected messages
+    joined together. If another message arrives while that call is still
+    waiting on the model, the call is cancelled and redone with the new message
+    included, so no completion is spent on a prompt that is already stale.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self.window = window
+        self._bursts = {}
+
+    def submit(self, chat_id, text, respond, create_task=asyncio.create_task):
+        burst = self._bursts.get(chat_id)
+        if burst is None or burst.committed:
+            burst = self._bursts[chat_id] = Burst()
+        elif burst.task is not None:
+            burst.task.cancel()
+        burst.messages.append(text)
+        burst.respond = respond
+        burst.task = create_task(self._run(chat_id, burst))
+        burst.task.add_done_callback(self._log_failure)
+        return burst
+
+    async def _run(self, chat_id, burst):
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            await burst.respond(burst.text, burst)
+        finally:
+            if self._bursts.get(chat_id) is burst and burst.task is asyncio.current_task():
+                del self._bursts[chat_id]
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Coalesced reply failed", exc_info=task.exception())
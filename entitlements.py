@@ -0,0 +1,162 @@
+import os
+import time
+import select
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+import sqlalchemy
+from sqlalchemy import text
+from models import AsyncSession, User, engine
+
+logger = logging.getLogger(__name__)
+
+ENTITLEMENT_TTL = float(os.getenv('ENTITLEMENT_TTL', 300))
+ENTITLEMENT_CACHE_SIZE = int(os.getenv('ENTITLEMENT_CACHE_SIZE', 10000))
+ENTITLEMENT_CHANNEL = 'entitlements'
+ENTITLEMENT_BULK_LIMIT = 1000
+
+
+Entitlement = namedtuple('Entitlement', ['allowed', 'billing_period'])
+NOT_ENTITLED = Entitlement(False, None)
+
+
+async def load_entitlement(telegram_id):
+    async with AsyncSession() as session:
+        result = await session.execute(
+            sqlalchemy.select(User.subscription_status, User.billing_period).where(User.telegram_id == telegram_id)
+        )
+        row = result.first()
+    if row is None:
+        return NOT_ENTITLED
+    status, billing_period = row
+    return Entitlement(status == 'active', billing_period if status == 'active' else None)
+
+
+class EntitlementCache:
+    """Per-process cache of whether a telegram_id may chat with the bot.
+
+    Entries expire after `ttl` seconds and the least recently used ones are
+    dropped once `maxsize` is reached. Ids in `whitelist` are always allowed
+    and never touch the database.
+    """
+
+    def __init__(self, whitelist, ttl=ENTITLEMENT_TTL, maxsize=ENTITLEMENT_CACHE_SIZE):
+        self.whitelist = whitelist
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # Bumped on every invalidation so a DB read that started before it
+        # cannot write a stale answer back into the cache.
+        self._generation = 0
+
+    def get(self, telegram_id):
+        key = str(telegram_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entitlement, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entitlement
+
+    def put(self, telegram_id, entitlement):
+        key = str(telegram_id)
+        self._entries[key] = (entitlement, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id=None):
+        self._generation += 1
+        if telegram_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(str(telegram_id), None)
+
+    async def lookup(self, telegram_id) -> Entitlement:
+        entitlement = self.get(telegram_id)
+        if entitlement is not None:
+            return entitlement
+        generation = self._generation
+        entitlement = await load_entitlement(str(telegram_id))
+        if generation == self._generation:
+            self.put(telegram_id, entitlement)
+        return entitlement
+
+    async def is_allowed(self, telegram_id) -> bool:
+        if telegram_id in self.whitelist:
+            return True
+        return (await self.lookup(telegram_id)).allowed
+
+
+def notify_entitlement_change(session, telegram_id):
+    """Queue an invalidation for `telegram_id` on the session's transaction.
+
+    Postgres delivers NOTIFY only once the transaction commits, so listeners
+    never see the change before the new status is readable.
+    """
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    session.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {'channel': ENTITLEMENT_CHANNEL, 'payload': str(telegram_id)},
+    )
+
+
+def notify_entitlement_changes(session, telegram_ids):
+    """Bulk form of `notify_entitlement_change`, sent as one statement.
+
+    Large batches collapse into a single empty payload, which tells listeners
+    to drop their whole cache instead of receiving thousands of messages.
+    """
+    if not telegram_ids or session.get_bind().dialect.name != 'postgresql':
+        return
+    if len(telegram_ids) > ENTITLEMENT_BULK_LIMIT:
+        session.execute(text("SELECT pg_notify(:channel, '')"), {'channel': ENTITLEMENT_CHANNEL})
+        return
+    session.execute(
+        text("SELECT pg_notify(:channel, telegram_id) FROM unnest(CAST(:ids AS text[])) AS telegram_id"),
+        {'channel': ENTITLEMENT_CHANNEL, 'ids': [str(telegram_id) for telegram_id in telegram_ids]},
+    )
+
+
+def start_invalidation_listener(cache, loop, poll_interval=5.0):
+    """LISTEN for entitlement changes on a background thread.
+
+    Each notification evicts one telegram_id from `cache` on the event loop.
+    After a lost connection the whole cache is dropped, since notifications
+    sent while disconnected are gone.
+    """
+    if engine.dialect.name != 'postgresql':
+        logger.info("Entitlement invalidation needs Postgres; relying on TTL only")
+        return None
+
+    def run():
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {ENTITLEMENT_CHANNEL}")
+                loop.call_soon_threadsafe(cache.invalidate)
+                logger.info("Listening for entitlement changes")
+                while True:
+                    if select.select([dbapi_connection], [], [], poll_interval) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        loop.call_soon_threadsafe(cache.invalidate, notify.payload or None)
+            except Exception as e:
+                logger.error(f"Entitlement listener failed, reconnecting: {e}")
+                if connection is not None:
+                    connection.invalidate()
+                time.sleep(poll_interval)
+
+    thread = threading.Thread(target=run, name='entitlement-listener', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import queue
+import zlib
+import logging
+import threading
+from datetime import datetime
+import stripe
+from models import Session, StripeEvent, StripeLink, engine, dialect_insert
+from observability import timed
+
+STRIPE_EVENT_WORKERS = int(os.getenv('STRIPE_EVENT_WORKERS', 4))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.getenv('STRIPE_EVENT_MAX_ATTEMPTS', 5))
+
+
+def ordering_key(event):
+    # Events for one subscriber must be applied in order. The Stripe customer
+    # is present on checkout sessions, invoices and charges alike, while
+    # telegram_id metadata is not, so it is the partition key. Disputes carry
+    # no customer; theirs is found through the ids recorded for the subscriber.
+    obj = event['data']['object']
+    if obj.get('customer'):
+        return str(obj['customer'])
+    metadata = obj.get('metadata') or {}
+    customer = linked_customer(metadata.get('telegram_id'), obj.get('charge'), obj.get('payment_intent'))
+    if customer:
+        return customer
+    if metadata.get('telegram_id'):
+        return str(metadata['telegram_id'])
+    return event['id']
+
+
+def linked_customer(telegram_id=None, *stripe_ids):
+    """The Stripe customer recorded for `telegram_id`, or for whoever owns `stripe_ids`."""
+    stripe_ids = [stripe_id for stripe_id in stripe_ids if stripe_id]
+    if not telegram_id and not stripe_ids:
+        return None
+    with Session() as session:
+        if not telegram_id:
+            telegram_id = (
+                session.query(StripeLink.telegram_id)
+                .filter(StripeLink.stripe_id.in_(stripe_ids))
+                .limit(1)
+                .scalar()
+            )
+            if not telegram_id:
+                return None
+        return (
+            session.query(StripeLink.stripe_id)
+            .filter(StripeLink.telegram_id == str(telegram_id), StripeLink.kind == 'customer')
+            .limit(1)
+            .scalar()
+        )
+
+
+class EventQueue:
+    """Durable, idempotent queue of Stripe webhook events.
+
+    `enqueue` only records the raw event (a no-op if its id was seen before)
+    and hands it to a worker thread. Each ordering key always maps to the same
+    worker, so one subscriber's events are processed one at a time, in order.
+    Rows left unfinished by a previous run are replayed by `start`, which
+    assumes a single webhook process owns the queue.
+    """
+
+    def __init__(self, handler, workers=STRIPE_EVENT_WORKERS, max_attempts=STRIPE_EVENT_MAX_ATTEMPTS):
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(work_queue,), name=f'stripe-events-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        with Session() as session:
+            session.query(StripeEvent).filter(StripeEvent.status == 'processing').update(
+                {StripeEvent.status: 'pending'}, synchronize_session=False)
+            session.commit()
+            pending = (
+                session.query(StripeEvent.id, StripeEvent.ordering_key)
+                .filter(StripeEvent.status == 'pending')
+                .order_by(StripeEvent.created, StripeEvent.received_at)
+                .all()
+            )
+        for event_id, key in pending:
+            self._dispatch(event_id, key)
+        if pending:
+            logging.info(f"Replaying {len(pending)} pending Stripe events")
+
+    def enqueue(self, event, payload):
+        key = ordering_key(event)
+        insert = dialect_insert(engine)
+        statement = insert(StripeEvent.__table__).values(
+            id=event['id'],
+            type=event['type'],
+            ordering_key=key,
+            payload=payload.decode('utf-8') if isinstance(payload, bytes) else payload,
+            status='pending',
+            attempts=0,
+            created=event.get('created'),
+            received_at=datetime.utcnow(),
+        ).on_conflict_do_nothing(index_elements=['id'])
+        with engine.begin() as connection:
+            inserted = connection.execute(statement).rowcount == 1
+        if inserted:
+            self._dispatch(event['id'], key)
+        else:
+            logging.info(f"Ignoring duplicate delivery of Stripe event {event['id']}")
+        return inserted
+
+    def join(self):
+        """Block until every event handed to the workers so far has been processed."""
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def _dispatch(self, event_id, key):
+        self._queues[zlib.crc32(key.encode('utf-8')) % len(self._queues)].put(event_id)
+
+    def _work(self, work_queue):
+        while True:
+            event_id = work_queue.get()
+            try:
+                self._process(event_id)
+            except Exception as e:
+                logging.error(f"Unexpected error processing Stripe event {event_id}: {e}")
+            finally:
+                work_queue.task_done()
+
+    def _claim(self, event_id):
+        with Session() as session:
+            claimed = (
+                session.query(StripeEvent)
+                .filter(StripeEvent.id == event_id, StripeEvent.status == 'pending')
+                .update({StripeEvent.status: 'processing'}, synchronize_session=False)
+            )
+            session.commit()
+            if not claimed:
+                return None
+            return session.query(StripeEvent.payload).filter(StripeEvent.id == event_id).scalar()
+
+    def _finish(self, event_id, status, attempts):
+        with Session() as session:
+            session.query(StripeEvent).filter(StripeEvent.id == event_id).update({
+                StripeEvent.status: status,
+                StripeEvent.attempts: attempts,
+                StripeEvent.processed_at: datetime.utcnow(),
+            }, synchronize_session=False)
+            session.commit()
+
+    def _process(self, event_id):
+        payload = self._claim(event_id)
+        if payload is None:
+            return
+        event = stripe.Event.construct_from(json.loads(payload), stripe.api_key)
+
+        # Retries happen inline so later events for the same key wait behind this one.
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with timed('stripe_event_seconds', 'Time to apply one Stripe event', type=event['type']):
+                    self.handler(event)
+            except Exception as e:
+                logging.error(f"Attempt {attempt} to process Stripe event {event_id} failed: {e}")
+                if attempt < self.max_attempts:
+                    time.sleep(min(2 ** attempt, 30))
+                continue
+            self._finish(event_id, 'done', attempt)
+            return
+        self._finish(event_id, 'failed', self.max_attempts)
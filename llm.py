@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+from clients import get_session
+from admission import PriorityScheduler
+from observability import histogram, timed
+
+load_dotenv()
+
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-3.5-turbo')
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 64))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 30))
+WHISPER_TIMEOUT = float(os.getenv('WHISPER_TIMEOUT', 60))
+
+# Global cap on in-flight OpenAI requests for this process. Callers beyond the
+# limit queue here by priority instead of piling up sockets on the upstream API.
+_slots = PriorityScheduler(LLM_MAX_CONCURRENCY, name='openai')
+_first_token = histogram('openai_first_token_seconds', 'Time from request to first streamed token')
+
+
+_openai = None
+
+
+def _client():
+    # The openai SDK takes a noticeable share of startup, so it is imported on
+    # first use (or by preload() once the bot is already taking updates).
+    global _openai
+    if _openai is None:
+        import openai
+        openai.api_key = os.getenv('OPENAI_KEY')
+        _openai = openai
+    return _openai
+
+
+def preload():
+    _client()
+
+
+async def _use_pool():
+    # openai reads its aiohttp session from a context variable; setting it per
+    # call makes every request in this task reuse the shared pool.
+    openai = _client()
+    openai.aiosession.set(await get_session())
+    return openai
+
+
+def _endpoint(api_base, api_key):
+    # Per-call overrides for backends other than the default OpenAI account.
+    return {key: value for key, value in (('api_base', api_base), ('api_key', api_key)) if value}
+
+
+async def chatCompletion(messages, model=LLM_MODEL, timeout=LLM_TIMEOUT, api_base=None, api_key=None):
+    async with _slots.slot(), timed('openai_request_seconds', 'OpenAI API latency', op='chat', model=model):
+        openai = await _use_pool()
+        response = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                request_timeout=timeout,
+                **_endpoint(api_base, api_key),
+            ),
+            timeout,
+        )
+    return response['choices'][0]['message']['content'].strip()
+
+
+async def transcribe(audio_file, timeout=WHISPER_TIMEOUT):
+    async with _slots.slot(), timed('openai_request_seconds', 'OpenAI API latency', op='transcribe', model='whisper-1'):
+        openai = await _use_pool()
+        result = await asyncio.wait_for(
+            openai.Audio.atranscribe("whisper-1", audio_file, request_timeout=timeout),
+            timeout,
+        )
+    return result['text']
+
+
+async def streamChatCompletion(messages, model=LLM_MODEL, timeout=LLM_TIMEOUT, api_base=None, api_key=None):
+    # Yields content deltas as they arrive. `timeout` bounds the wait for the
+    # first response and for each following chunk, not the whole completion.
+    async with _slots.slot(), timed('openai_request_seconds', 'OpenAI API latency', op='chat_stream', model=model):
+        started = time.perf_counter()
+        openai = await _use_pool()
+        stream = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                stream=True,
+                request_timeout=timeout,
+                **_endpoint(api_base, api_key),
+            ),
+            timeout,
+        )
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), timeout)
+            except StopAsyncIteration:
+                break
+            delta = chunk['choices'][0]['delta'].get('content')
+            if delta:
+                if started is not None:
+                    _first_token.observe(time.perf_counter() - started, model=model)
+                    started = None
+                yield delta
@@ -0,0 +1,238 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from llm import LLM_MODEL, LLM_TIMEOUT, chatCompletion, streamChatCompletion
+from admission import AdmissionRejected
+from observability import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+LLM_FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL')
+LLM_FALLBACK_API_BASE = os.getenv('LLM_FALLBACK_API_BASE')
+LLM_FALLBACK_API_KEY = os.getenv('LLM_FALLBACK_API_KEY')
+# A duplicate request is sent once the first has taken longer than this
+# percentile of the backend's recent latencies, clamped to the bounds below.
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', 2.0))  # used until enough samples exist
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', 0.25))
+LLM_HEDGE_MAX_DELAY = float(os.getenv('LLM_HEDGE_MAX_DELAY', 10.0))
+# Hedges allowed per request, on average. 0 turns hedging off.
+LLM_HEDGE_BUDGET = float(os.getenv('LLM_HEDGE_BUDGET', 0.05))
+LLM_BACKEND_MAX_FAILURES = int(os.getenv('LLM_BACKEND_MAX_FAILURES', 3))
+LLM_BACKEND_COOLDOWN = float(os.getenv('LLM_BACKEND_COOLDOWN', 30))
+
+MIN_SAMPLES = 20
+
+_backend_latency = histogram('llm_backend_seconds', 'Latency per LLM backend (time to first token for streams)')
+_hedges = counter('llm_hedges_total', 'Hedged LLM requests by which copy answered first')
+_failovers = counter('llm_failovers_total', 'LLM requests retried on another backend after an error')
+
+
+class Backend:
+    """One model on one endpoint, with its recent latencies and failures."""
+
+    def __init__(self, name, model, api_base=None, api_key=None, window=200):
+        self.name = name
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key
+        self.latencies = {'chat': deque(maxlen=window), 'stream': deque(maxlen=window)}
+        self.failures = 0
+        self.failed_at = 0.0
+
+    @property
+    def options(self):
+        return {'model': self.model, 'api_base': self.api_base, 'api_key': self.api_key}
+
+    def healthy(self):
+        return (self.failures < LLM_BACKEND_MAX_FAILURES
+                or time.monotonic() - self.failed_at > LLM_BACKEND_COOLDOWN)
+
+    def percentile(self, op, pct):
+        samples = self.latencies[op]
+        if len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def succeeded(self, op, seconds):
+        self.latencies[op].append(seconds)
+        self.failures = 0
+        _backend_latency.observe(seconds, backend=self.name, op=op, outcome='ok')
+
+    def failed(self, op, seconds):
+        self.failures += 1
+        self.failed_at = time.monotonic()
+        _backend_latency.observe(seconds, backend=self.name, op=op, outcome='error')
+
+    def stats(self):
+        stats = {op: {'samples': len(samples), 'p50': self.percentile(op, 50), 'p95': self.percentile(op, 95)}
+                 for op, samples in self.latencies.items()}
+        stats['failures'] = self.failures
+        return stats
+
+
+class HedgeBudget:
+    """Each request earns `ratio` of a hedge, so at most that share of requests is duplicated."""
+
+    def __init__(self, ratio=LLM_HEDGE_BUDGET, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.credit = 0.0
+
+    def earn(self):
+        self.credit = min(self.burst, self.credit + self.ratio)
+
+    def spend(self):
+        if self.credit < 1:
+            return False
+        self.credit -= 1
+        return True
+
+
+class LLMRouter:
+    """Sends each completion to the healthiest backend, with hedging and failover.
+
+    If the first copy hasn't answered after the backend's recent p95 (see
+    LLM_HEDGE_PERCENTILE), a duplicate goes to the next backend, or to the
+    same one if there is no other, and whichever answers first is used. Hedges
+    are limited by a HedgeBudget so average spend barely moves. A copy that
+    fails is retried once on every other backend before the error is raised.
+    """
+
+    def __init__(self, backends, timeout=LLM_TIMEOUT, budget=None):
+        self.backends = list(backends)
+        self.timeout = timeout
+        self.budget = budget or HedgeBudget()
+
+    def _order(self):
+        # Healthy backends first, otherwise in configured order.
+        return sorted(self.backends, key=lambda backend: not backend.healthy())
+
+    def hedge_delay(self, backend, op):
+        delay = backend.percentile(op, LLM_HEDGE_PERCENTILE)
+        if delay is None:
+            delay = LLM_HEDGE_DELAY
+        return min(LLM_HEDGE_MAX_DELAY, max(LLM_HEDGE_MIN_DELAY, delay))
+
+    async def complete(self, messages):
+        """Like llm.chatCompletion, routed."""
+        async def call(backend):
+            return await chatCompletion(messages, timeout=self.timeout, **backend.options), None
+        text, _ = await self._race('chat', call)
+        return text
+
+    async def stream(self, messages):
+        """Like llm.streamChatCompletion, routed.
+
+        Hedging and failover only apply until the first chunk arrives;
+        after that the winning stream is followed to the end.
+        """
+        async def call(backend):
+            chunks = streamChatCompletion(messages, timeout=self.timeout, **backend.options)
+            try:
+                return await chunks.__anext__(), chunks
+            except StopAsyncIteration:
+                # A completion with no text is still an answer.
+                return '', chunks
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        # For streams a copy "answers" with its first chunk; the winner's
+        # remaining chunks are then read here.
+        first, chunks = await self._race('stream', call)
+        try:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    async def _race(self, op, call):
+        # Returns the result of `call(backend)` from whichever copy succeeds
+        # first. `call` returns a (value, stream-or-None) pair.
+        self.budget.earn()
+        untried = self._order()
+        attempts = {}  # task -> (backend, is_hedge)
+        error = None
+
+        async def run(backend):
+            started = time.perf_counter()
+            try:
+                result = await call(backend)
+            except AdmissionRejected:
+                raise  # our own queue is full; no backend is to blame
+            except Exception:
+                backend.failed(op, time.perf_counter() - started)
+                raise
+            backend.succeeded(op, time.perf_counter() - started)
+            return result
+
+        def launch(backend, hedge=False):
+            attempts[asyncio.create_task(run(backend))] = (backend, hedge)
+            if backend in untried:
+                untried.remove(backend)
+
+        first = untried[0]
+        launch(first)
+        hedge_after = self.hedge_delay(first, op) if self.budget.ratio > 0 else None
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(attempts, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_after = None
+                    if self.budget.spend():
+                        launch(untried[0] if untried else first, hedge=True)
+                    continue
+                for task in done:
+                    backend, hedge = attempts.pop(task)
+                    if task.exception() is None:
+                        if hedge or any(other_hedge for _, other_hedge in attempts.values()):
+                            _hedges.inc(winner='hedge' if hedge else 'original')
+                        return task.result()
+                    if isinstance(task.exception(), AdmissionRejected):
+                        # Our own queue turned this copy away, which says
+                        # nothing about the backend; a copy still running
+                        # may yet answer.
+                        if not attempts:
+                            raise task.exception()
+                        continue
+                    error = task.exception()
+                    logger.warning(f"LLM backend {backend.name} failed: {error!r}")
+                if not attempts and untried:
+                    _failovers.inc(backend=untried[0].name)
+                    launch(untried[0])
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+            for task in attempts:
+                await _discard(task)
+
+    def stats(self):
+        return {backend.name: backend.stats() for backend in self.backends}
+
+
+async def _discard(task):
+    # Wait for a losing copy to unwind and close its stream, if it got one.
+    try:
+        result = await task
+    except BaseException:
+        return
+    _, chunks = result
+    if chunks is not None:
+        await chunks.aclose()
+
+
+def default_backends():
+    backends = [Backend('primary', LLM_MODEL)]
+    if LLM_FALLBACK_MODEL or LLM_FALLBACK_API_BASE:
+        backends.append(Backend('fallback', LLM_FALLBACK_MODEL or LLM_MODEL,
+                                LLM_FALLBACK_API_BASE, LLM_FALLBACK_API_KEY))
+    return backends
+
+
+router = LLMRouter(default_backends())
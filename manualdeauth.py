@@ -1,16 +1,31 @@
-from models import User, Session
-
-def deactivate_subscription(telegram_id):
-    telegram_id_str = str(telegram_id)  # Convert the telegram_id to a string
-    with Session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id_str).first()
-        if user and user.subscription_status == 'active':
-            user.subscription_status = 'inactive'
-            session.commit()
-            print(f"User with telegram_id {telegram_id} subscription has been deactivated manually.")
-        else:
-            print(f"User with telegram_id {telegram_id} not found or is already inactive.")
-
-# Call the function
-telegram_id_to_deactivate = 6152661939  # replace with the actual telegram_id
-deactivate_subscription(telegram_id_to_deactivate)
+import sys
+import argparse
+from sweeper import deactivate_subscriptions
+
+
+def read_ids(args):
+    ids = list(args.telegram_ids)
+    if args.file:
+        with (sys.stdin if args.file == '-' else open(args.file)) as f:
+            ids.extend(line.strip() for line in f)
+    return [telegram_id for telegram_id in ids if telegram_id and not telegram_id.startswith('#')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deactivate subscriptions manually.")
+    parser.add_argument('telegram_ids', nargs='*', help="telegram ids to deactivate")
+    parser.add_argument('-f', '--file', help="file with one telegram id per line, or - for stdin")
+    args = parser.parse_args()
+
+    telegram_ids = read_ids(args)
+    if not telegram_ids:
+        parser.error("no telegram ids given")
+
+    deactivated = deactivate_subscriptions(telegram_ids)
+    for telegram_id in deactivated:
+        print(f"User with telegram_id {telegram_id} subscription has been deactivated manually.")
+    print(f"Deactivated {len(deactivated)} of {len(telegram_ids)} users; the rest were not found or already inactive.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict, namedtuple
+from sqlalchemy import delete, select
+from models import AsyncSession, ConversationTurn, ConversationSummary
+from llm import chatCompletion
+from admission import BACKGROUND_PRIORITY, current_priority
+
+logger = logging.getLogger(__name__)
+
+MEMORY_TURNS = int(os.getenv('MEMORY_TURNS', 20))
+MEMORY_FOLD_BATCH = int(os.getenv('MEMORY_FOLD_BATCH', 6))
+MEMORY_CACHE_SIZE = int(os.getenv('MEMORY_CACHE_SIZE', 5000))
+# Tokens for a whole prompt: system prompt, history and the new message.
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500))
+SUMMARY_MAX_WORDS = int(os.getenv('SUMMARY_MAX_WORDS', 150))
+
+SUMMARY_PROMPT = (
+    "You maintain a short running summary of a chat between a user and their friend Jamie. "
+    "Merge the new lines into the existing summary. Keep names, facts about the user, plans and "
+    f"running jokes; drop small talk. Reply with the updated summary only, at most {SUMMARY_MAX_WORDS} words."
+)
+
+Turn = namedtuple('Turn', ['id', 'role', 'content', 'tokens'])
+
+_encoding = None  # False once tiktoken turned out not to be installed
+
+
+def load_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+        except ImportError:
+            _encoding = False
+        else:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = load_encoding()
+    if not encoding:
+        # Close enough for budgeting English chat text.
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+class Conversation:
+    """Recent turns plus a rolling summary of everything older."""
+
+    def __init__(self, telegram_id, summary='', summary_tokens=0, turns=()):
+        self.telegram_id = telegram_id
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.turns = list(turns)
+        self.lock = asyncio.Lock()
+
+    def context_messages(self, budget=CONTEXT_TOKEN_BUDGET):
+        """Summary and the newest turns that fit in `budget` tokens, oldest first."""
+        messages = []
+        if self.summary and self.summary_tokens <= budget:
+            budget -= self.summary_tokens
+            summary = {"role": "system", "content": f"Summary of our earlier conversation: {self.summary}"}
+        else:
+            summary = None
+        for turn in reversed(self.turns):
+            if turn.tokens > budget:
+                break
+            budget -= turn.tokens
+            messages.append({"role": turn.role, "content": turn.content})
+        messages.reverse()
+        if summary:
+            messages.insert(0, summary)
+        return messages
+
+
+async def _load(telegram_id):
+    async with AsyncSession() as session:
+        summary = await session.get(ConversationSummary, telegram_id)
+        rows = (await session.scalars(
+            select(ConversationTurn)
+            .where(ConversationTurn.telegram_id == telegram_id)
+            .order_by(ConversationTurn.id.desc())
+            .limit(MEMORY_TURNS)
+        )).all()
+        turns = [Turn(row.id, row.role, row.content, row.token_count) for row in reversed(rows)]
+    if summary:
+        return Conversation(telegram_id, summary.summary, summary.token_count, turns)
+    return Conversation(telegram_id, turns=turns)
+
+
+async def _insert_turns(telegram_id, turns):
+    async with AsyncSession() as session:
+        rows = [ConversationTurn(telegram_id=telegram_id, role=t.role, content=t.content, token_count=t.tokens)
+                for t in turns]
+        session.add_all(rows)
+        await session.commit()
+        return [row.id for row in rows]
+
+
+async def _save_summary(telegram_id, summary, token_count, folded_ids):
+    async with AsyncSession() as session:
+        row = await session.get(ConversationSummary, telegram_id)
+        if row is None:
+            session.add(ConversationSummary(telegram_id=telegram_id, summary=summary, token_count=token_count))
+        else:
+            row.summary = summary
+            row.token_count = token_count
+        await session.execute(delete(ConversationTurn).where(ConversationTurn.id.in_(folded_ids)))
+        await session.commit()
+
+
+class ConversationMemory:
+    """Per-user conversation history, cached in process and persisted in the DB.
+
+    Recording a turn only touches memory; the insert and any summarisation run
+    in a background task so they never add latency to a reply.
+    """
+
+    def __init__(self, maxsize=MEMORY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._conversations = OrderedDict()
+        self._tasks = set()
+
+    async def get(self, telegram_id):
+        telegram_id = str(telegram_id)
+        conversation = self._conversations.get(telegram_id)
+        if conversation is None:
+            conversation = await _load(telegram_id)
+            conversation = self._conversations.setdefault(telegram_id, conversation)
+        self._conversations.move_to_end(telegram_id)
+        while len(self._conversations) > self.maxsize:
+            self._conversations.popitem(last=False)
+        return conversation
+
+    def record(self, conversation, user_message, reply):
+        new_turns = [
+            Turn(None, 'user', user_message, count_tokens(user_message)),
+            Turn(None, 'assistant', reply, count_tokens(reply)),
+        ]
+        conversation.turns.extend(new_turns)
+        task = asyncio.create_task(self._persist(conversation, new_turns))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Wait for pending inserts and summaries, e.g. before shutting down."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _persist(self, conversation, new_turns):
+        # Summaries are housekeeping; let live replies go first.
+        current_priority.set(BACKGROUND_PRIORITY)
+        async with conversation.lock:
+            try:
+                ids = await _insert_turns(conversation.telegram_id, new_turns)
+                saved = {id(turn): Turn(turn_id, *turn[1:]) for turn, turn_id in zip(new_turns, ids)}
+                conversation.turns = [saved.get(id(turn), turn) for turn in conversation.turns]
+                if len(conversation.turns) > MEMORY_TURNS:
+                    await self._fold(conversation)
+            except Exception as e:
+                logger.error(f"Failed to persist conversation for {conversation.telegram_id}: {e}")
+
+    async def _fold(self, conversation):
+        overflow = max(MEMORY_FOLD_BATCH, len(conversation.turns) - MEMORY_TURNS)
+        folded = [turn for turn in conversation.turns[:overflow] if turn.id is not None]
+        if not folded:
+            return
+        lines = "\n".join(f"{turn.role}: {turn.content}" for turn in folded)
+        summary = await chatCompletion([
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{conversation.summary or '(none)'}\n\nNew lines:\n{lines}"},
+        ])
+        summary_tokens = count_tokens(summary)
+        await _save_summary(conversation.telegram_id, summary, summary_tokens, [turn.id for turn in folded])
+        folded_ids = {turn.id for turn in folded}
+        conversation.turns = [turn for turn in conversation.turns if turn.id not in folded_ids]
+        conversation.summary = summary
+        conversation.summary_tokens = summary_tokens
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from sqlalchemy import delete, select
+from telegram.ext import BasePersistence, PersistenceInput
+from models import AsyncSession, BotState, async_engine, dialect_insert
+from observability import counter, timed
+
+logger = logging.getLogger(__name__)
+
+# How often python-telegram-bot hands changed data to the persistence.
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', 10))
+# Users whose data is loaded at startup, most recently active first. Anyone
+# else is read once, on their first update after a restart.
+PERSISTENCE_WARM_USERS = int(os.getenv('PERSISTENCE_WARM_USERS', 1000))
+# Lets the rest of one persistence run join the batch before it is written.
+FLUSH_DELAY = 1.0
+# Rows per INSERT, which keeps statements under SQLite's bound-parameter limit.
+FLUSH_CHUNK = 500
+# How often the whitelist is re-read, so changes made by other webhook
+# workers reach this one.
+WHITELIST_REFRESH = float(os.getenv('WHITELIST_REFRESH', 10))
+
+_rows = counter('persistence_rows_total', 'Persistence rows written or deleted')
+
+
+def _encode(value):
+    # Sets are stored as sorted lists.
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    # sort_keys makes equal values encode identically, which is what the
+    # change detection compares.
+    return json.dumps(value, default=_encode, sort_keys=True)
+
+
+class DatabasePersistence(BasePersistence):
+    """Keeps user data, bot data and conversation states in the bot_state table.
+
+    Writes are write-behind: python-telegram-bot passes every used entry to
+    update_*() each `update_interval` seconds, entries whose JSON hasn't
+    changed since the last write are dropped, and the rest are written
+    together in one transaction shortly after. Handlers themselves never wait
+    on the database. Chat data and callback data are not used by the bot and
+    not stored.
+
+    The whitelist, bot_data['whitelist'], is kept as one 'whitelist' row per
+    id rather than inside the bot_data row, and refresh_bot_data re-reads
+    those rows every WHITELIST_REFRESH seconds. That way several processes
+    share it: each writes only the ids it added or removed, and picks up the
+    others' changes without undoing its own unsaved ones.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL, warm_users=PERSISTENCE_WARM_USERS):
+        super().__init__(store_data=PersistenceInput(chat_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.warm_users = warm_users
+        self._saved = {}  # (kind, key) -> JSON as last written
+        self._dirty = {}  # (kind, key) -> JSON to write, or None to delete
+        self._loaded_users = set()
+        self._whitelist_rows = set()  # ids in the whitelist rows as last read
+        self._whitelist_read_at = 0.0
+        self._flusher = None
+        self._lock = asyncio.Lock()
+
+    # -- loading ---------------------------------------------------------
+
+    async def _rows_of(self, statement):
+        async with AsyncSession() as session:
+            rows = (await session.execute(statement)).all()
+        for kind, key, data in rows:
+            self._saved[(kind, key)] = data
+        return rows
+
+    async def get_user_data(self):
+        rows = await self._rows_of(
+            select(BotState.kind, BotState.key, BotState.data)
+            .where(BotState.kind == 'user')
+            .order_by(BotState.updated_at.desc())
+            .limit(self.warm_users)
+        )
+        self._loaded_users.update(int(key) for _, key, _ in rows)
+        logger.info("Loaded data for %d recently active users", len(rows))
+        return {int(key): json.loads(data) for _, key, data in rows}
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Called before every handler; only the first call for a user who
+        # wasn't warm-loaded reads the database.
+        if user_id in self._loaded_users:
+            return
+        rows = await self._rows_of(
+            select(BotState.kind, BotState.key, BotState.data)
+            .where(BotState.kind == 'user', BotState.key == str(user_id))
+        )
+        self._loaded_users.add(user_id)
+        if rows:
+            for name, value in json.loads(rows[0].data).items():
+                user_data.setdefault(name, value)
+
+    async def get_bot_data(self):
+        rows = await self._rows_of(
+            select(BotState.kind, BotState.key, BotState.data).where(BotState.kind == 'bot')
+        )
+        bot_data = json.loads(rows[0].data) if rows else {}
+        # Ids saved inside the bot_data row by earlier versions are moved to
+        # whitelist rows on the next write.
+        bot_data['whitelist'] = set(bot_data.get('whitelist', ())) | await self._read_whitelist()
+        return bot_data
+
+    async def _read_whitelist(self):
+        rows = await self._rows_of(
+            select(BotState.kind, BotState.key, BotState.data).where(BotState.kind == 'whitelist')
+        )
+        whitelist = {int(key) for _, key, _ in rows}
+        for telegram_id in self._whitelist_rows - whitelist:
+            self._saved.pop(('whitelist', str(telegram_id)), None)
+        self._whitelist_rows = whitelist
+        self._whitelist_read_at = time.monotonic()
+        return whitelist
+
+    async def get_conversations(self, name):
+        rows = await self._rows_of(
+            select(BotState.kind, BotState.key, BotState.data).where(BotState.kind == f'conversation:{name}')
+        )
+        return {tuple(json.loads(key)): json.loads(data) for _, key, data in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        # Called before every handler; reads the database at most once every
+        # WHITELIST_REFRESH seconds.
+        if time.monotonic() - self._whitelist_read_at < WHITELIST_REFRESH:
+            return
+        before = self._whitelist_rows
+        after = await self._read_whitelist()
+        # Apply only what changed in the database, so ids added or removed
+        # here but not yet written are left alone. The set is changed in
+        # place because the entitlement cache holds the same object.
+        whitelist = bot_data.setdefault('whitelist', set())
+        whitelist |= after - before
+        whitelist -= before - after
+
+    # -- write-behind ----------------------------------------------------
+
+    def _mark(self, kind, key, value):
+        entry = (kind, str(key))
+        data = None if value is None else dumps(value)
+        if self._saved.get(entry) == data:
+            self._dirty.pop(entry, None)
+            return
+        self._dirty[entry] = data
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def update_user_data(self, user_id, data):
+        # Most users never store anything; they get no row at all.
+        self._mark('user', user_id, data or None)
+
+    async def drop_user_data(self, user_id):
+        self._mark('user', user_id, None)
+
+    async def update_bot_data(self, data):
+        data = dict(data)
+        whitelist = {str(telegram_id) for telegram_id in data.pop('whitelist', ())}
+        for telegram_id in whitelist:
+            self._mark('whitelist', telegram_id, True)
+        for kind, key in list(self._saved):
+            if kind == 'whitelist' and key not in whitelist:
+                self._mark('whitelist', key, None)
+        self._mark('bot', '', data)
+
+    async def update_conversation(self, name, key, new_state):
+        # A state of None means the conversation ended.
+        self._mark(f'conversation:{name}', json.dumps(list(key)), new_state)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(FLUSH_DELAY)
+            try:
+                await self._write()
+            except Exception as e:
+                logger.error(f"Could not write persistence data, will retry: {e}")
+                await asyncio.sleep(self.update_interval)
+
+    async def flush(self):
+        """Write whatever is still buffered; called by the Application on shutdown."""
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        await self._write()
+
+    async def _write(self):
+        async with self._lock:
+            batch, self._dirty = self._dirty, {}
+            if not batch:
+                return
+            # Assume success so values changed during the write are compared
+            # against what is being written.
+            self._saved.update(batch)
+            upserts = [{'kind': kind, 'key': key, 'data': data}
+                       for (kind, key), data in batch.items() if data is not None]
+            deletes = {}
+            for (kind, key), data in batch.items():
+                if data is None:
+                    deletes.setdefault(kind, []).append(key)
+            try:
+                with timed('persistence_flush_seconds', 'Time to write a batch of persistence data'):
+                    async with AsyncSession() as session:
+                        for start in range(0, len(upserts), FLUSH_CHUNK):
+                            statement = dialect_insert(async_engine)(BotState).values(upserts[start:start + FLUSH_CHUNK])
+                            await session.execute(statement.on_conflict_do_update(
+                                index_elements=[BotState.kind, BotState.key],
+                                set_={'data': statement.excluded.data, 'updated_at': statement.excluded.updated_at},
+                            ))
+                        for kind, keys in deletes.items():
+                            await session.execute(delete(BotState).where(BotState.kind == kind, BotState.key.in_(keys)))
+                        await session.commit()
+            except BaseException:
+                # Put the batch back, behind anything that changed meanwhile.
+                for entry, data in batch.items():
+                    self._saved.pop(entry, None)
+                    self._dirty.setdefault(entry, data)
+                raise
+            for (kind, key), data in batch.items():
+                if kind == 'whitelist':
+                    (self._whitelist_rows.discard if data is None else self._whitelist_rows.add)(int(key))
+            _rows.inc(len(upserts), op='upsert')
+            _rows.inc(sum(len(keys) for keys in deletes.values()), op='delete')
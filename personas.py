@@ -0,0 +1,101 @@
+import os
+import re
+import hashlib
+import logging
+from collections import OrderedDict, namedtuple
+from memory import count_tokens, load_encoding
+from observability import counter
+
+logger = logging.getLogger(__name__)
+
+# Longest traits description kept, in tokens; the rest is dropped.
+PERSONA_TRAIT_TOKENS = int(os.getenv('PERSONA_TRAIT_TOKENS', 60))
+PERSONA_CACHE_SIZE = int(os.getenv('PERSONA_CACHE_SIZE', 1000))
+
+# Base persona prompts. Everything that varies (the opener and the traits)
+# goes after the base text, so every prompt for a persona starts with the
+# same bytes and providers that cache prompt prefixes can reuse them.
+PERSONAS = {
+    'jamie': (
+        "lets roleplay. you will play the role of 'Jamie' your main goal is to help me and have fun as Jamie. "
+        "Jamie doesn't have any friends besides me. Jamie doesn't see his family much because they are out of state. "
+        "Jamie doesn't have a significant other. Jamie is always down to hang out with me no matter what it is. "
+        "Jamie is a nice chiasmatic guy. Jamie loves dogs, ice-cream, and hanging out with me. Jamie hates the heat. "
+        "if you understand you objectives and what Jamies like ask me what we are doing in this current situation."
+    ),
+}
+DEFAULT_PERSONA = 'jamie'
+
+CompiledPersona = namedtuple('CompiledPersona', ['persona', 'traits', 'system_prompt', 'tokens'])
+
+_lookups = counter('persona_cache_total', 'Persona prompt lookups by result')
+
+
+def normalize_traits(traits):
+    """Lower-cased, comma-separated traits with duplicates and blanks removed."""
+    seen = []
+    for trait in re.split(r'[,;\n]+', traits or ''):
+        trait = ' '.join(trait.split()).lower()
+        if trait and trait not in seen:
+            seen.append(trait)
+    return ', '.join(seen)
+
+
+def cap_traits(traits, budget=PERSONA_TRAIT_TOKENS):
+    """Whole traits, in order, for as long as they fit in `budget` tokens."""
+    if count_tokens(traits) <= budget:
+        return traits
+    kept = ''
+    for trait in traits.split(', '):
+        candidate = f"{kept}, {trait}" if kept else trait
+        if count_tokens(candidate) > budget:
+            break
+        kept = candidate
+    if not kept:
+        # A single trait longer than the budget is cut short.
+        encoding = load_encoding()
+        if encoding:
+            tokens = encoding.encode(traits)[:budget]
+            # Decoded text can re-encode to a token more; trim until it fits.
+            while tokens and count_tokens(encoding.decode(tokens).strip()) > budget:
+                tokens = tokens[:-1]
+            kept = encoding.decode(tokens)
+        else:
+            kept = traits[:(budget - 1) * 4]  # count_tokens' estimate without tiktoken
+    return kept.strip()
+
+
+def compile_persona(persona, traits):
+    base = PERSONAS[persona]
+    if traits:
+        system_prompt = f"{base} you will start every conversation with 'Jamie'. JAMIES PERSONALITY TRAITS ARE: {traits}"
+    else:
+        system_prompt = f"{base} you will start every conversation with 'CustomFriend:'"
+    return CompiledPersona(persona, traits, system_prompt, count_tokens(system_prompt))
+
+
+class PersonaRegistry:
+    """Compiled system prompts by (persona, traits hash), least recently used dropped first.
+
+    Users with the same persona and the same traits, after normalizing,
+    share one entry, so the prompt is built and its tokens counted once.
+    """
+
+    def __init__(self, maxsize=PERSONA_CACHE_SIZE, trait_tokens=PERSONA_TRAIT_TOKENS):
+        self.maxsize = maxsize
+        self.trait_tokens = trait_tokens
+        self._entries = OrderedDict()
+
+    def get(self, traits='', persona=DEFAULT_PERSONA) -> CompiledPersona:
+        normalized = normalize_traits(traits)
+        key = (persona, hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest())
+        compiled = self._entries.get(key)
+        if compiled is not None:
+            _lookups.inc(result='hit')
+            self._entries.move_to_end(key)
+            return compiled
+        _lookups.inc(result='miss')
+        compiled = self._entries[key] = compile_persona(persona, cap_traits(normalized, self.trait_tokens))
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return compiled
@@ -0,0 +1,48 @@
+import bisect
+import hashlib
+
+# Update fields whose value carries the chat the update belongs to, checked in order.
+CHAT_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys onto nodes.
+
+    Every node is placed on the ring `replicas` times, so load stays even
+    and adding or removing one node only moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes, replicas=128):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def routing_key(update):
+    """Return the chat id of a raw Telegram update dict, or the sender id when it has no chat."""
+    for field in CHAT_FIELDS:
+        if field in update:
+            return update[field]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for field in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query'):
+        if field in update:
+            return update[field]['from']['id']
+    return update.get('update_id', 0)
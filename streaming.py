@@ -0,0 +1,93 @@
+import os
+import time
+import asyncio
+import logging
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Telegram tolerates roughly one edit per second per chat before it starts
+# answering with RetryAfter, so partial text is batched up between edits.
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+MAX_MESSAGE_LENGTH = 4096
+
+
+class MessageStreamer:
+    """Shows a reply as it is generated by editing a single Telegram message.
+
+    The first chunk is sent right away; later chunks are coalesced and pushed
+    at most once every `interval` seconds from a background task, so reading
+    the token stream is never held up by Telegram round trips.
+    """
+
+    def __init__(self, reply_to: Message, interval: float = STREAM_EDIT_INTERVAL):
+        self.reply_to = reply_to
+        self.interval = interval
+        self.text = ''
+        self.message = None
+        self._shown = ''
+        self._changed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._pump_task = None
+
+    async def feed(self, chunk: str) -> None:
+        self.text += chunk
+        if self.message is None:
+            if self.text.strip():
+                await self._push()
+                self._pump_task = asyncio.create_task(self._pump())
+        else:
+            self._changed.set()
+
+    async def finish(self) -> str:
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                # Never keeps the final text from being sent.
+                logger.warning(f"Streaming edits stopped early: {e!r}")
+        final = self.text.strip()
+        if final:
+            await self._push(final[:MAX_MESSAGE_LENGTH])
+            for start in range(MAX_MESSAGE_LENGTH, len(final), MAX_MESSAGE_LENGTH):
+                await self.reply_to.reply_text(final[start:start + MAX_MESSAGE_LENGTH])
+        return final
+
+    async def _pump(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            started = time.monotonic()
+            try:
+                await self._push()
+            except TelegramError as e:
+                # A failed intermediate edit is superseded by the next one.
+                logger.warning(f"Intermediate edit failed, will try again: {e!r}")
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    async def _push(self, text: str = None) -> None:
+        async with self._lock:
+            if text is None:
+                text = self.text.strip()[:MAX_MESSAGE_LENGTH]
+            if not text or text == self._shown:
+                return
+            while True:
+                try:
+                    if self.message is None:
+                        self.message = await self.reply_to.reply_text(text)
+                    else:
+                        await self.message.edit_text(text)
+                    self._shown = text
+                    return
+                except RetryAfter as e:
+                    logger.info("Edit throttled by Telegram, retrying in %ss", e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                except BadRequest as e:
+                    if 'not modified' in str(e).lower():
+                        self._shown = text
+                        return
+                    raise
@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from models import Session, User
+from entitlements import notify_entitlement_changes
+
+# Off by default: subscribed_until of subscribers who checked out before
+# renewals were recorded is stale until backfill.py has been run once.
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', 0))
+# Stripe finalises a renewal invoice about an hour after the period ends and
+# may retry the charge, so a subscription is only expired once this much
+# time has passed without webhook.py recording a paid invoice.
+SUBSCRIPTION_GRACE_HOURS = float(os.getenv('SUBSCRIPTION_GRACE_HOURS', 24))
+
+
+def expire_lapsed_subscriptions(now=None):
+    """Mark every active subscription whose subscribed_until has passed as inactive.
+
+    subscribed_until is set from the billing period at checkout and moved to
+    the end of each paid period on invoice.paid (see webhook.py).
+
+    This is one set-based UPDATE served by ix_users_status_subscribed_until,
+    however many users lapse. Returns the affected telegram_ids.
+    """
+    now = now or datetime.utcnow()
+    with Session() as session:
+        result = session.execute(
+            update(User)
+            .where(User.subscription_status == 'active',
+                   User.subscribed_until < now - timedelta(hours=SUBSCRIPTION_GRACE_HOURS))
+            .values(subscription_status='inactive')
+            .returning(User.telegram_id)
+        )
+        expired = result.scalars().all()
+        notify_entitlement_changes(session, expired)
+        session.commit()
+    return expired
+
+
+def deactivate_subscriptions(telegram_ids, batch_size=1000):
+    """Deactivate the given telegram_ids in batches; returns the ids that changed."""
+    telegram_ids = [str(telegram_id) for telegram_id in telegram_ids]
+    deactivated = []
+    with Session() as session:
+        for start in range(0, len(telegram_ids), batch_size):
+            batch = telegram_ids[start:start + batch_size]
+            result = session.execute(
+                update(User)
+                .where(User.telegram_id.in_(batch), User.subscription_status == 'active')
+                .values(subscription_status='inactive')
+                .returning(User.telegram_id)
+            )
+            changed = result.scalars().all()
+            notify_entitlement_changes(session, changed)
+            session.commit()
+            deactivated.extend(changed)
+    return deactivated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expire subscriptions whose paid period has ended.")
+    parser.add_argument('--every', type=int, metavar='SECONDS',
+                        help="keep running and sweep on this interval instead of once")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    while True:
+        expired = expire_lapsed_subscriptions()
+        logging.info(f"Expired {len(expired)} lapsed subscriptions")
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
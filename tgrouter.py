@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+from contextlib import asynccontextmanager
+import httpx
+import uvicorn
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+from sharding import HashRing, routing_key
+from observability import REGISTRY, CONTENT_TYPE, setup_logging, timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+WORKER_URLS = [url for url in os.getenv("WORKER_URLS", "").split(",") if url]
+WORKER_HOST = os.getenv("WORKER_HOST", "127.0.0.1")
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", 8100))
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_router(worker_urls, secret=TELEGRAM_WEBHOOK_SECRET, client=None):
+    """ASGI app that receives Telegram's webhook and forwards each update to a worker.
+
+    Workers are picked by consistent hashing on the chat id, so a chat's
+    conversation state, caches and ordering all stay on one worker.
+    """
+    ring = HashRing(worker_urls)
+    state = {'client': client}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        owns_client = state['client'] is None
+        if owns_client:
+            state['client'] = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0),
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            )
+        if TELEGRAM_WEBHOOK_URL and TELEGRAM_TOKEN:
+            await set_webhook(state['client'], TELEGRAM_WEBHOOK_URL, secret)
+        yield
+        if owns_client:
+            await state['client'].aclose()
+
+    async def telegram(request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return Response(status_code=403)
+        body = await request.body()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return Response(status_code=400)
+
+        worker = ring.node_for(routing_key(update))
+        headers = {'Content-Type': 'application/json'}
+        if secret:
+            headers[SECRET_HEADER] = secret
+        try:
+            async with timed('router_forward_seconds', 'Time to hand an update to its worker', worker=worker):
+                response = await state['client'].post(f"{worker}/update", content=body, headers=headers)
+        except httpx.HTTPError as e:
+            logger.error(f"Could not forward update to {worker}: {e}")
+            return Response(status_code=503)
+        # A non-2xx answer makes Telegram redeliver the update later.
+        return Response(status_code=200 if response.is_success else 503)
+
+    return Starlette(routes=[
+        Route('/telegram', telegram, methods=['POST']),
+        Route('/metrics', metrics, methods=['GET']),
+    ], lifespan=lifespan)
+
+
+async def metrics(request):
+    return Response(REGISTRY.render(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def set_webhook(client, url, secret=None):
+    data = {'url': url, 'max_connections': 100}
+    if secret:
+        data['secret_token'] = secret
+    response = await client.post(f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/setWebhook", data=data)
+    logger.info(f"setWebhook {url}: {response.status_code} {response.text}")
+
+
+def create_worker_app(application, secret=TELEGRAM_WEBHOOK_SECRET):
+    """ASGI app a bot worker serves; it feeds forwarded updates into `application`."""
+    from telegram import Update
+
+    async def update(request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return Response(status_code=403)
+        await application.update_queue.put(Update.de_json(await request.json(), application.bot))
+        return Response(status_code=200)
+
+    async def healthz(request):
+        return Response('ok')
+
+    return Starlette(routes=[
+        Route('/update', update, methods=['POST']),
+        Route('/healthz', healthz, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ])
+
+
+async def run_worker(application, host=WORKER_HOST, port=WORKER_BASE_PORT):
+    """Run `application` without its own updater, taking updates over HTTP from the router."""
+    server = uvicorn.Server(uvicorn.Config(create_worker_app(application), host=host, port=port, log_level='warning'))
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def spawn_workers(count, base_port=WORKER_BASE_PORT):
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    processes, urls = [], []
+    for index in range(count):
+        port = base_port + index
+        env = dict(os.environ, BOT_MODE='worker', WORKER_INDEX=str(index), WORKER_PORT=str(port))
+        processes.append(subprocess.Popen([sys.executable, bot_path], env=env))
+        urls.append(f"http://{WORKER_HOST}:{port}")
+    return processes, urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the bot in webhook mode across several worker processes.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes to start locally (ignored when WORKER_URLS is set)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.getenv('ROUTER_PORT', 8443)))
+    args = parser.parse_args()
+
+    setup_logging()
+    processes, urls = ([], WORKER_URLS) if WORKER_URLS else spawn_workers(args.workers)
+    try:
+        uvicorn.run(create_router(urls), host=args.host, port=args.port, log_level='warning')
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', '.tts_cache')
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFKC', text)
+    text = text.replace('\u2019', "'").replace('\u201c', '"').replace('\u201d', '"')
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def cache_key(text, voice_id, model_id, voice_settings):
+    material = json.dumps([normalize_text(text), voice_id, model_id, voice_settings],
+                          sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class TTSCache:
+    """Content-addressed store of synthesised audio, bounded by total size.
+
+    Each clip lives in `directory` as `<sha256>.<extension>`. Recency is tracked in
+    memory and mirrored to file mtimes so the LRU order survives a restart.
+    """
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES, extension='mp3'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.{self.extension}")
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        suffix = f".{self.extension}"
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(suffix)], stat.st_size))
+        self._index = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._size = sum(self._index.values())
+
+    def _read(self, key):
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._index.pop(key, 0)
+            return None
+        return audio
+
+    def _write(self, key, audio):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            self._load_index()
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+        evicted = []
+        with self._lock:
+            self._size += len(audio) - self._index.pop(key, 0)
+            self._index[key] = len(audio)
+            while self._size > self.max_bytes and len(self._index) > 1:
+                old_key, old_size = self._index.popitem(last=False)
+                self._size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, text, voice_id, model_id, voice_settings):
+        audio = await asyncio.to_thread(self._read, cache_key(text, voice_id, model_id, voice_settings))
+        if audio is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return audio
+
+    async def put(self, text, voice_id, model_id, voice_settings, audio):
+        try:
+            await asyncio.to_thread(self._write, cache_key(text, voice_id, model_id, voice_settings), audio)
+        except OSError as e:
+            logger.error(f"Could not store TTS audio in cache: {e}")
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._index or ()),
+            'bytes': self._size,
+        }
@@ -0,0 +1,86 @@
+import os
+import asyncio
+import logging
+from io import BytesIO
+from dotenv import load_dotenv
+from clients import get_session
+from ttscache import TTSCache
+from audio import VOICE_FORMAT, AudioError, to_voice
+from admission import PriorityScheduler
+from observability import counter, timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ELEVEN = os.getenv("ELEVEN_LABS_API_KEY")
+ELEVEN_API_BASE = os.getenv("ELEVEN_API_BASE", "https://api.elevenlabs.io")
+ELEVEN_VOICE_ID = os.getenv("ELEVEN_VOICE_ID", "fkogAIAZGZ11v5ryG9tl")
+ELEVEN_MODEL_ID = "eleven_monolingual_v1"
+ELEVEN_VOICE_SETTINGS = {
+    "stability": 0,
+    "similarity_boost": 0
+}
+TTS_MAX_CONCURRENCY = int(os.getenv('TTS_MAX_CONCURRENCY', 32))
+TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', 60))
+
+_tts_slots = PriorityScheduler(TTS_MAX_CONCURRENCY, name='elevenlabs')
+tts_cache = TTSCache(extension=VOICE_FORMAT)
+_tts_cache_requests = counter('tts_cache_requests_total', 'TTS cache lookups by result')
+
+
+async def download_voice(bot, file_id) -> BytesIO:
+    # Telegram voice notes are small, so they are kept in memory rather than
+    # written to a shared path where concurrent messages would clobber them.
+    async with timed('telegram_file_download_seconds', 'Time to fetch a voice note from Telegram'):
+        voice_file = await bot.get_file(file_id)
+        audio = BytesIO(await voice_file.download_as_bytearray())
+    audio.name = 'voice.ogg'  # the OpenAI client uses the name to infer the format
+    return audio
+
+
+async def synthesize(text, voice_id=ELEVEN_VOICE_ID):
+    """Return the ElevenLabs rendering of `text` as VOICE_FORMAT bytes, or None."""
+    cached = await tts_cache.get(text, voice_id, ELEVEN_MODEL_ID, ELEVEN_VOICE_SETTINGS)
+    if cached is not None:
+        _tts_cache_requests.inc(result='hit')
+        return cached
+    _tts_cache_requests.inc(result='miss')
+
+    payload = {
+        "text": text,
+        "model_id": ELEVEN_MODEL_ID,
+        "voice_settings": ELEVEN_VOICE_SETTINGS
+    }
+    headers = {
+        'accept': 'audio/mpeg',
+        'xi-api-key': ELEVEN,
+        'Content-Type': 'application/json'
+    }
+    url = f"{ELEVEN_API_BASE}/v1/text-to-speech/{voice_id}/stream"
+
+    session = await get_session()  # also imports aiohttp, see clients.py
+    import aiohttp
+    async with _tts_slots.slot(), timed('elevenlabs_request_seconds', 'ElevenLabs TTS latency'):
+        try:
+            async with session.post(url, json=payload, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=TTS_TIMEOUT)) as response:
+                if response.status != 200:
+                    logger.error("ElevenLabs returned %s: %s", response.status, await response.text())
+                    return None
+                audio = bytearray()
+                async for chunk in response.content.iter_chunked(16384):
+                    audio.extend(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"ElevenLabs request failed: {e}")
+            return None
+    if not audio:
+        return None
+    try:
+        audio = await to_voice(bytes(audio))
+    except AudioError as e:
+        # Still worth sending, just not in the format the cache holds.
+        logger.error(f"Could not transcode TTS audio: {e}")
+        return bytes(audio)
+    await tts_cache.put(text, voice_id, ELEVEN_MODEL_ID, ELEVEN_VOICE_SETTINGS, audio)
+    return audio
@@ -1,6 +1,9 @@
 from flask import Flask, request
 from datetime import datetime, timedelta
-from models import User, Session
+from models import User, Session, StripeLink, dialect_insert, upsert_user
+from entitlements import notify_entitlement_change
+from eventqueue import EventQueue
+from observability import REGISTRY, CONTENT_TYPE, setup_logging, timed
 import stripe
 import os
 import logging
@@ -11,13 +14,32 @@ STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 stripe.api_key = STRIPE_SECRET_KEY
 stripe_webhook_secret = os.getenv("stripe_webhook_secret")
 
+# Length of each paid period, used until Stripe reports the actual period end
+# on the subscription's invoices.
+PERIOD_DAYS = {'daily': 1, 'monthly': 30, 'bi-annually': 182, 'annually': 365}
+
 app = Flask(__name__)
 
-logging.basicConfig(level=logging.INFO)  # This will print logs to the console
+setup_logging()
+
+
+def stripe_call(name, func, *args, **kwargs):
+    with timed('stripe_api_seconds', 'Stripe API latency', call=name):
+        return func(*args, **kwargs)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE}
 
 
 @app.route('/stripe_webhook', methods=['POST'])
 def stripe_webhook():
+    with timed('stripe_webhook_ack_seconds', 'Time to acknowledge a Stripe webhook'):
+        return receive_stripe_event()
+
+
+def receive_stripe_event():
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature')
 
@@ -36,30 +58,114 @@ def stripe_webhook():
     # Log the event type for debugging purposes
     logging.info(f"Received event: {event['type']}")
 
-    handle_event(event)
+    # Only persist the event here; the queue workers do the Stripe calls and
+    # DB updates, so the acknowledgement doesn't wait on them.
+    try:
+        event_queue.enqueue(event, payload)
+    except Exception as e:
+        logging.error(f"Failed to store event {event.get('id')}: {e}")
+        return 'Could not store event', 500
     return '', 200
 
 
+def remember_stripe_ids(session, telegram_id, **stripe_ids):
+    # Map Stripe object ids (customer=..., subscription=..., ...) to a telegram_id
+    # so later events can be resolved without calling the Stripe API.
+    rows = [{'stripe_id': stripe_id, 'kind': kind, 'telegram_id': str(telegram_id)}
+            for kind, stripe_id in stripe_ids.items() if stripe_id]
+    if not rows:
+        return
+    insert = dialect_insert(session.get_bind())
+    statement = insert(StripeLink.__table__).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=['stripe_id'], set_={'telegram_id': statement.excluded.telegram_id}
+    )
+    session.execute(statement)
+
+
+def lookup_stripe_links(*stripe_ids):
+    # {stripe_id: telegram_id} for those of `stripe_ids` that are recorded.
+    stripe_ids = [stripe_id for stripe_id in stripe_ids if stripe_id]
+    if not stripe_ids:
+        return {}
+    with Session() as session:
+        return dict(
+            session.query(StripeLink.stripe_id, StripeLink.telegram_id)
+            .filter(StripeLink.stripe_id.in_(stripe_ids))
+        )
+
+
+def cache_stripe_ids(telegram_id, **stripe_ids):
+    with Session() as session:
+        remember_stripe_ids(session, telegram_id, **stripe_ids)
+        session.commit()
+
+
+# Events whose object is a Charge (disputes are charge.* but not charges).
+CHARGE_EVENTS = ('charge.succeeded', 'charge.failed', 'charge.refunded')
+
+
 def extract_telegram_id_from_event(event):
-    # Directly extract telegram_id from the event's metadata if present
-    if 'metadata' in event['data']['object'] and 'telegram_id' in event['data']['object']['metadata']:
-        return event['data']['object']['metadata']['telegram_id']
+    obj = event['data']['object']
 
-    # For charge events, try to find the metadata in related objects
+    # Directly extract telegram_id from the event's metadata if present
+    if 'metadata' in obj and 'telegram_id' in obj['metadata']:
+        return obj['metadata']['telegram_id']
+
+    # Resolve through the ids recorded at checkout or on an earlier lookup
+    charge_id = obj['id'] if event['type'] in CHARGE_EVENTS else None
+    links = lookup_stripe_links(obj.get('customer'), obj.get('subscription'), obj.get('invoice'),
+                                obj.get('payment_intent'), obj.get('charge'), charge_id)
+    if links:
+        telegram_id = next(iter(links.values()))
+        if charge_id and charge_id not in links:
+            # Lets a later dispute, which has no customer, find its subscriber.
+            cache_stripe_ids(telegram_id, charge=charge_id, payment_intent=obj.get('payment_intent'))
+        return telegram_id
+
+    # Invoices for a subscription created at checkout carry its metadata
+    if event['type'].startswith('invoice.') and obj.get('subscription'):
+        subscription = stripe_call('Subscription.retrieve', stripe.Subscription.retrieve, obj['subscription'])
+        telegram_id = (subscription.get('metadata') or {}).get('telegram_id')
+        if telegram_id:
+            cache_stripe_ids(telegram_id, subscription=obj['subscription'], customer=obj.get('customer'))
+            return telegram_id
+
+    # For charge events, fall back to the metadata of related objects and
+    # remember what we find so the next event for them stays local
     if event['type'].startswith('charge.'):
-        charge = event['data']['object']
+        charge = obj
 
         # If charge is linked to an invoice, try retrieving telegram_id from the invoice
         if charge.get('invoice'):
-            invoice = stripe.Invoice.retrieve(charge['invoice'])
+            invoice = stripe_call('Invoice.retrieve', stripe.Invoice.retrieve, charge['invoice'])
             if 'telegram_id' in invoice['metadata']:
-                return invoice['metadata']['telegram_id']
+                telegram_id = invoice['metadata']['telegram_id']
 
             # If the invoice is linked to a subscription, try retrieving telegram_id from the subscription
-            if invoice.get('subscription'):
-                subscription = stripe.Subscription.retrieve(invoice['subscription'])
+            elif invoice.get('subscription'):
+                subscription = stripe_call('Subscription.retrieve', stripe.Subscription.retrieve, invoice['subscription'])
                 if 'telegram_id' in subscription['metadata']:
-                    return subscription['metadata']['telegram_id']
+                    telegram_id = subscription['metadata']['telegram_id']
+
+            if telegram_id:
+                cache_stripe_ids(telegram_id, invoice=invoice['id'], subscription=invoice.get('subscription'),
+                                 customer=charge.get('customer'), payment_intent=charge.get('payment_intent'),
+                                 charge=charge['id'] if event['type'] in CHARGE_EVENTS else None)
+                return telegram_id
+
+        # Otherwise the PaymentIntent may carry the metadata
+        if charge.get('payment_intent'):
+            try:
+                payment_intent = stripe_call('PaymentIntent.retrieve', stripe.PaymentIntent.retrieve, charge['payment_intent'])
+                if 'metadata' in payment_intent and 'telegram_id' in payment_intent['metadata']:
+                    telegram_id = payment_intent['metadata']['telegram_id']
+                    cache_stripe_ids(telegram_id, payment_intent=payment_intent['id'],
+                                     customer=charge.get('customer'),
+                                     charge=charge['id'] if event['type'] in CHARGE_EVENTS else None)
+                    return telegram_id
+            except Exception as e:
+                logging.error(f"Failed to fetch PaymentIntent for charge: {e}")
 
     logging.warning("No telegram_id found in metadata or related entities.")
     return None
@@ -69,16 +175,6 @@ def extract_telegram_id_from_event(event):
 
 def handle_event(event):
     telegram_id = extract_telegram_id_from_event(event)
-    
-    # If we can't find the telegram_id from the event metadata, attempt to fetch from PaymentIntent
-    if not telegram_id and 'charge' in event['data']['object']:
-        try:
-            charge = event['data']['object']
-            payment_intent = stripe.PaymentIntent.retrieve(charge['payment_intent'])
-            if 'metadata' in payment_intent and 'telegram_id' in payment_intent['metadata']:
-                telegram_id = payment_intent['metadata']['telegram_id']
-        except Exception as e:
-            logging.error(f"Failed to fetch PaymentIntent for charge: {e}")
 
     if not telegram_id:
         logging.warning(f"Cannot process event of type {event['type']} due to missing telegram_id.")
@@ -96,6 +192,9 @@ def handle_event(event):
     elif event['type'] == 'charge.refunded':
         handle_refund(event, telegram_id)
 
+    elif event['type'] == 'invoice.paid':
+        handle_paid_invoice(event, telegram_id)
+
     elif event['type'] == 'charge.succeeded':
         logging.info(f"Received successful charge for telegram_id {telegram_id}")
 
@@ -106,47 +205,85 @@ def handle_event(event):
 
 
 def handle_successful_session(event, telegram_id):
+    checkout_session = event['data']['object']
     with Session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        if user:
-            user.subscription_status = 'active'
-            user.subscribed_until = datetime.utcnow() + timedelta(days=30)  # Assuming a monthly subscription
-            session.commit()
-            print(f"User with telegram_id {telegram_id} subscription updated to active until {user.subscribed_until}")
-        else:
-            new_user = User(telegram_id=telegram_id, subscription_status='active', subscribed_until=datetime.utcnow() + timedelta(days=30))
-            session.add(new_user)
-            session.commit()
-            print(f"New user with telegram_id {telegram_id} added with active subscription until {new_user.subscribed_until}")
+        remember_stripe_ids(session, telegram_id,
+                            customer=checkout_session.get('customer'),
+                            subscription=checkout_session.get('subscription'),
+                            invoice=checkout_session.get('invoice'),
+                            payment_intent=checkout_session.get('payment_intent'))
+        billing_period = (checkout_session.get('metadata') or {}).get('billing_period')
+        values = {
+            'subscription_status': 'active',
+            'subscribed_until': datetime.utcnow() + timedelta(days=PERIOD_DAYS.get(billing_period, 30)),
+        }
+        if billing_period:
+            values['billing_period'] = billing_period
+        # Creates the user or activates the existing one in a single statement.
+        session.execute(upsert_user(session.get_bind(), telegram_id, **values))
+        notify_entitlement_change(session, telegram_id)
+        session.commit()
+        logging.info(f"User with telegram_id {telegram_id} subscription active until {values['subscribed_until']}")
             
     session = event['data']['object']
     
     # If the session resulted in a subscription, ensure it has the telegram_id metadata
     if session.get('subscription'):
         subscription_id = session['subscription']
-        subscription = stripe.Subscription.retrieve(subscription_id)
+        subscription = stripe_call('Subscription.retrieve', stripe.Subscription.retrieve, subscription_id)
 
         # Check if the metadata is not already present
         if 'telegram_id' not in subscription['metadata']:
             subscription.metadata['telegram_id'] = telegram_id
-            subscription.save()
+            stripe_call('Subscription.save', subscription.save)
 
     # If the session resulted in a payment intent, ensure it has the telegram_id metadata
     if session.get('payment_intent'):
         payment_intent_id = session['payment_intent']
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        payment_intent = stripe_call('PaymentIntent.retrieve', stripe.PaymentIntent.retrieve, payment_intent_id)
         
         # Check if the metadata is not already present
         if 'telegram_id' not in payment_intent['metadata']:
             payment_intent.metadata['telegram_id'] = telegram_id
-            payment_intent.save()
+            stripe_call('PaymentIntent.save', payment_intent.save)
             
+def invoice_period_end(invoice):
+    # The subscription line's period is the one just paid for; the invoice's
+    # own period_end is only a fallback.
+    for line in (invoice.get('lines') or {}).get('data') or []:
+        if line.get('period', {}).get('end'):
+            return datetime.utcfromtimestamp(line['period']['end'])
+    if invoice.get('period_end'):
+        return datetime.utcfromtimestamp(invoice['period_end'])
+    return None
+
+def handle_paid_invoice(event, telegram_id):
+    # Renewals: every paid invoice moves subscribed_until to the end of the
+    # period it paid for, so the expiry sweep leaves renewing users alone.
+    period_end = invoice_period_end(event['data']['object'])
+    with Session() as session:
+        user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        if not user:
+            logging.warning(f"No user found with telegram_id {telegram_id} for paid invoice")
+            return
+        if period_end is None:
+            period_end = datetime.utcnow() + timedelta(days=PERIOD_DAYS.get(user.billing_period, 30))
+        # Invoices can arrive out of order; never move the end date backwards.
+        if user.subscribed_until and user.subscribed_until > period_end:
+            period_end = user.subscribed_until
+        user.subscription_status = 'active'
+        user.subscribed_until = period_end
+        notify_entitlement_change(session, telegram_id)
+        session.commit()
+        logging.info(f"User with telegram_id {telegram_id} subscription renewed until {period_end}")
+
 def handle_failed_payment(event, telegram_id):
     with Session() as session:
         try:
             user = session.query(User).filter(User.telegram_id == telegram_id).first()
             if user:
                 user.subscription_status = 'inactive'
+                notify_entitlement_change(session, telegram_id)
                 session.commit()
                 logging.info(f"User with telegram_id {telegram_id} subscription marked as inactive due to failed payment")
             else:
@@ -160,6 +297,7 @@ def handle_dispute(event, telegram_id):
             user = session.query(User).filter(User.telegram_id == telegram_id).first()
             if user:
                 user.subscription_status = 'inactive'
+                notify_entitlement_change(session, telegram_id)
                 session.commit()
                 logging.info(f"User with telegram_id {telegram_id} subscription marked as inactive due to dispute")
             else:
@@ -170,8 +308,8 @@ def handle_dispute(event, telegram_id):
 def handle_refund(event, telegram_id):
     if not telegram_id:
         charge_id = event['data']['object']['id']
-        charge = stripe.Charge.retrieve(charge_id)
-        payment_intent = stripe.PaymentIntent.retrieve(charge.payment_intent)
+        charge = stripe_call('Charge.retrieve', stripe.Charge.retrieve, charge_id)
+        payment_intent = stripe_call('PaymentIntent.retrieve', stripe.PaymentIntent.retrieve, charge.payment_intent)
         telegram_id = payment_intent.metadata.get('telegram_id')
     if not telegram_id:
         logging.warning(f"Cannot process event of type {event['type']} due to missing telegram_id.")
@@ -181,6 +319,7 @@ def handle_refund(event, telegram_id):
             user = session.query(User).filter(User.telegram_id == telegram_id).first()
             if user:
                 user.subscription_status = 'inactive'
+                notify_entitlement_change(session, telegram_id)
                 session.commit()
                 logging.info(f"User with telegram_id {telegram_id} subscription marked as inactive due to refund")
             else:
@@ -188,5 +327,19 @@ def handle_refund(event, telegram_id):
         except Exception as e:
             logging.error(f"Error processing refund for telegram_id {telegram_id}: {e}")
 
+event_queue = EventQueue(handle_event)
+
+
+def create_app():
+    """The webhook app with its event queue running.
+
+    Starting the queue replays unfinished events from the database, so it is
+    done here rather than at import, and by one process only: serve this
+    with a single worker (e.g. gunicorn -w 1 'webhook:create_app()').
+    """
+    event_queue.start()
+    return app
+
+
 if __name__ == '__main__':
-    app.run(port=5000)
+    create_app().run(port=5000)